@@ -1,32 +1,138 @@
+import asyncio
+import functools
+import logging
 import math
+import re
 import time
-from datetime import datetime
-from typing import List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 
-import pytz
 import telegram
 
+import sched_cond
+from outbox import Outbox
+
 DEBUG = False
 
 DAY_SECONDS = 24 * 60 * 60
 HOUR_SECONDS = 60 * 60
 MINUTE_SECONDS = 60
 
+# Threads shared by every plugin for blocking work, see BotPlugin.run_blocking()
+BLOCKING_WORKERS = 4
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="plugin")
+
+
+def previous_day_start(start_time, now=None):
+    if now is None:
+        now = time.time()
+    return math.floor((now - start_time) / DAY_SECONDS) * DAY_SECONDS + start_time
+
+
+# Time zone of users who have not chosen one, in minutes east of UTC
+DEFAULT_UTC_OFFSET = 8 * 60
+DAY_MINUTES = DAY_SECONDS // MINUTE_SECONDS
+
+# "HH:MM" of every minute of a day and ":SS" of every second of a minute;
+# the table of each time zone is a rotation of _CLOCK sharing its strings
+_CLOCK = ["{:02}:{:02}".format(m // 60, m % 60) for m in range(DAY_MINUTES)]
+_SECONDS = [":{:02}".format(s) for s in range(60)]
+
+
+@functools.lru_cache(maxsize=64)
+def _date_to_str(day: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(day * DAY_SECONDS))
+
+
+class TimeZone:
+    """A fixed offset from UTC with its formatting tables.
+
+    Use time_zone() to get one; instances are cached and shared by
+    every user in the zone.
+    """
+    __slots__ = ("offset", "name", "clock")
+
+    def __init__(self, offset: int):
+        # Minutes east of UTC
+        self.offset = offset
+        hours, minutes = divmod(abs(offset), 60)
+        if offset == 0:
+            self.name = "UTC"
+        else:
+            self.name = "UTC{}{}{}".format("-" if offset < 0 else "+", hours, ":{:02}".format(minutes) if minutes else "")
+        # "HH:MM" here of every minute of the UTC day
+        shift = offset % DAY_MINUTES
+        self.clock = _CLOCK[shift:] + _CLOCK[:shift]
+
+    def day_time(self, t: int) -> str:
+        """Format a time of day (or a timestamp) given in seconds UTC as HH:MM here."""
+        return self.clock[int(t) // MINUTE_SECONDS % DAY_MINUTES]
+
+    def timestamp(self, t: float) -> str:
+        """Format a timestamp as YYYY-mm-dd HH:MM:SS here."""
+        day, second = divmod(math.floor(t) + self.offset * MINUTE_SECONDS, DAY_SECONDS)
+        return _date_to_str(day) + " " + _CLOCK[second // MINUTE_SECONDS] + _SECONDS[second % MINUTE_SECONDS]
+
+    def from_local(self, hours: int, minutes: int) -> int:
+        """The time of day in seconds UTC of hours:minutes here."""
+        return (hours * 60 + minutes - self.offset) % DAY_MINUTES * MINUTE_SECONDS
+
+
+_zones: Dict[int, TimeZone] = dict()
+
+
+def time_zone(offset: Optional[int] = None) -> TimeZone:
+    """The shared TimeZone offset minutes east of UTC, by default DEFAULT_UTC_OFFSET."""
+    if offset is None:
+        offset = DEFAULT_UTC_OFFSET
+    zone = _zones.get(offset)
+    if zone is None:
+        zone = _zones[offset] = TimeZone(offset)
+    return zone
+
+
+_offset_pattern = re.compile(r"^(?:UTC|GMT)?([+-]?)(\d{1,2})(?::?(\d{2}))?$|^(?:UTC|GMT)$", re.IGNORECASE)
+
 
-def previous_day_start(start_time):
-    return math.floor((time.time() - start_time) / DAY_SECONDS) * DAY_SECONDS + start_time
+def parse_utc_offset(s: str) -> Optional[int]:
+    """Parse "+8", "8", "-3:30", "UTC+5:45" or "UTC" into minutes east of UTC.
 
+    Returns None unless s is a real offset: a multiple of 15 minutes
+    between UTC-12 and UTC+14.
 
-def timestamp_to_str(t: float):
-    timezone_local = pytz.FixedOffset(480)
-    dt = pytz.utc.localize(datetime.utcfromtimestamp(t))
-    return dt.astimezone(timezone_local).strftime("%Y-%m-%d %H:%M:%S")
+    """
+    r = _offset_pattern.match(s.strip())
+    if r is None:
+        return None
+    if r.group(2) is None:
+        return 0
+    minutes = int(r.group(3) or 0)
+    if minutes >= 60:
+        return None
+    offset = int(r.group(2)) * 60 + minutes
+    if r.group(1) == "-":
+        offset = -offset
+    if offset % 15 or not -12 * 60 <= offset <= 14 * 60:
+        return None
+    return offset
 
 
-def day_time_to_str(t: int):
-    while t < 0:
-        t += DAY_SECONDS
-    return "{:02}:{:02}".format((t // HOUR_SECONDS + 8) % 24, (t % HOUR_SECONDS) // MINUTE_SECONDS)
+def timestamp_to_str(t: float, zone: Optional[TimeZone] = None):
+    return (zone or time_zone()).timestamp(t)
+
+
+def day_time_to_str(t: int, zone: Optional[TimeZone] = None):
+    return (zone or time_zone()).day_time(t)
+
+
+_root_logger = logging.getLogger()
+
+
+def debug_time(message: str, t: float):
+    """logging.debug(message, t as a timestamp), formatting t only if debug logging is on."""
+    if _root_logger.isEnabledFor(logging.DEBUG):
+        logging.debug(message, timestamp_to_str(t))
 
 
 def time_interval_to_remain(interval: int):
@@ -48,12 +154,15 @@ def time_interval_to_remain(interval: int):
 
 
 class User:
-    def __init__(self, user_id, username, first_name, last_name, language_code):
+    __slots__ = ("user_id", "username", "first_name", "last_name", "language_code", "zone")
+
+    def __init__(self, user_id, username, first_name, last_name, language_code, utc_offset=None):
         self.user_id = int(user_id)
         self.username = username
         self.first_name = first_name
         self.last_name = last_name
         self.language_code = language_code
+        self.zone = time_zone(utc_offset)
 
     @property
     def name(self):
@@ -64,13 +173,71 @@ class User:
         return self.first_name
 
 
+class LRUCache:
+    """A dict bounded to maxsize entries, evicting the least recently used."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        data = self._data
+        data[key] = value
+        data.move_to_end(key)
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
 class BotPlugin:
     prefix = ""
+    # Sub-commands the plugin handles, the only ones metrics are labelled with
+    commands: FrozenSet[str] = frozenset()
+    # Maximum number of events the plugin may have pending in the shared scheduler
+    scheduler_limit: Optional[int] = None
 
-    def __init__(self, bot: telegram.Bot):
+    def __init__(self, bot: telegram.Bot, scheduler: sched_cond.scheduler_condition, outbox: Outbox):
         self.bot = bot
+        self.outbox = outbox
+        self.scheduler = scheduler.namespace(self.prefix, self.scheduler_limit)
+
+    def now(self) -> float:
+        """The time on the scheduler's clock, which may be simulated."""
+        return self.scheduler.timefunc()
+
+    def day_start(self, start_time):
+        """previous_day_start() on the scheduler's clock."""
+        return previous_day_start(start_time, self.scheduler.timefunc())
+
+    def start(self):
+        """Start background work; called once the event loop is running."""
+
+    async def stop(self):
+        """Flush and stop background work on shutdown."""
+
+    async def run_blocking(self, function: Callable, *args):
+        """Run function(*args) on the shared bounded thread pool.
+
+        Use it for work that would otherwise block the event loop, like
+        a database read; at most BLOCKING_WORKERS calls run at once and
+        the rest wait in line.
+
+        """
+        return await asyncio.get_running_loop().run_in_executor(_blocking_executor, function, *args)
 
-    def handle_command(self, user: telegram.User, chat: telegram.Chat, parameters: List[str]) -> Optional[str]:
+    async def handle_command(self, user: telegram.User, chat: telegram.Chat, parameters: List[str]) -> Optional[str]:
         return ""
 
     async def handle_callback(self, callback: telegram.CallbackQuery) -> Tuple[str, bool]:
@@ -1,12 +1,15 @@
-import logging
+import asyncio
+import functools
+import heapq
 import re
-import sqlite3
-import threading
 from html import escape
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
+import fire_times
+import persistence
 import sched_cond
 from BotPlugin import *
+from outbox import BULK
 
 time_remain_template = "Please remember to hack a portal! {} remaining."
 time_remain = [
@@ -40,8 +43,35 @@ emergency_remain = [
 if DEBUG:
     time_remain = [55, 45, 35, 25, 15, 5]
 
+# Only cohorts whose next timer fires within HORIZON have events in the
+# scheduler; the others wait in HackBot.deferred until refill() runs.
+HORIZON = HOUR_SECONDS
+REFILL_INTERVAL = HORIZON // 2
+
+CohortKey = Tuple[int, Tuple[int, ...]]
+
+DEFAULT_SETTING: Tuple[int, ...] = tuple(time_remain)
+# One shared tuple per distinct timer setting
+_settings: Dict[Tuple[int, ...], Tuple[int, ...]] = {DEFAULT_SETTING: DEFAULT_SETTING}
+
+
+def intern_setting(setting) -> Tuple[int, ...]:
+    setting = tuple(setting)
+    return _settings.setdefault(setting, setting)
+
+
+@functools.lru_cache(maxsize=1024)
+def reminder_texts(setting: Tuple[int, ...]) -> Tuple[str, ...]:
+    """The reminder sent at each delay of a timer setting."""
+    return tuple(time_remain_template.format(time_interval_to_remain(delay)) for delay in setting)
+
+
+EMERGENCY_TEXTS = tuple(thirty_six_template.format(time_interval_to_remain(delay)) for delay in emergency_remain)
+
 
 class HackUser(User):
+    __slots__ = ("start_time", "last_hack_time", "timer_setting", "message_records")
+
     def __init__(
         self,
         user_id,
@@ -52,35 +82,68 @@ class HackUser(User):
         start_time,
         time_setting,
         last_hack_time,
+        utc_offset=None,
     ):
-        super().__init__(user_id, username, first_name, last_name, language_code)
+        super().__init__(user_id, username, first_name, last_name, language_code, utc_offset)
         self.start_time = start_time
         self.last_hack_time = last_hack_time
 
         if time_setting is not None:
-            self.timer_setting = [int(x) for x in time_setting.split()]
+            self.timer_setting: Optional[Tuple[int, ...]] = intern_setting(int(x) for x in time_setting.split())
         else:
             self.timer_setting = None
+        # (chat_id, message_id) of reminders to delete, allocated on first use
+        self.message_records: Optional[List[Tuple[int, int]]] = None
+
+    @property
+    def cohort_key(self) -> CohortKey:
+        if self.timer_setting is None:
+            return self.start_time, DEFAULT_SETTING
+        return self.start_time, self.timer_setting
+
+
+class Cohort:
+    """Users sharing a start time and timer setting.
+
+    A cohort has a single new_day event and a single reminder chain,
+    which fan out to every member that has not hacked yet.
+    """
+
+    def __init__(self, key: CohortKey):
+        self.key = key
+        self.start_time, self.timer_setting = key
+        # A new setting makes a new cohort, so these never go stale
+        self.texts = reminder_texts(self.timer_setting)
+        self.members: Set[int] = set()
         self.main_timer: Optional[sched_cond.Event] = None
-        self.timers: List[sched_cond.Event] = []
-        self.message_records = []
+        self.timer: Optional[sched_cond.Event] = None
+        # Fire time of the entry in HackBot.deferred standing for the timers
+        self.deferred: Optional[float] = None
 
 
 class HackBot(BotPlugin):
     prefix = "hack"
-
-    def __init__(self, bot: telegram.Bot):
-        super().__init__(bot)
-        self.db = sqlite3.connect("data/hack_data.sqlite", check_same_thread=False)
-        self.scheduler = sched_cond.scheduler_condition(
-            timefunc=time.time, delayfunc=time.sleep
-        )
-        threading.Thread(target=self.scheduler.run).start()
+    commands = frozenset(("start", "status", "alarm", "stop", "record", "zone"))
+
+    def __init__(self, bot: telegram.Bot, scheduler: sched_cond.scheduler_condition, outbox: Outbox,
+                 markup_cache_size: int = 16384, live_message: bool = False):
+        super().__init__(bot, scheduler, outbox)
+        # Edit the latest reminder in place instead of sending a new one
+        # and deleting the old ones, see remind()
+        self.live_message = live_message
+        self.db = persistence.WriteBehindDB("data/hack_data.sqlite")
         self.users: Dict[int, HackUser] = dict()
-
-        for user in self.db.execute(
+        # user_id -> the "Portal hacked" keyboard of their messages
+        self.markups = LRUCache(markup_cache_size)
+        self.cohorts: Dict[CohortKey, Cohort] = dict()
+        # (fire time, cohort key) of cohorts whose timers are not materialized yet
+        self.deferred: List[Tuple[float, CohortKey]] = []
+
+        # Minutes east of UTC, NULL for DEFAULT_UTC_OFFSET
+        self.db.add_column("user", "utc_offset", "INTEGER")
+        for user in self.db.query(
             "SELECT user.user_id, username, first_name, last_name, "
-            "language_code, start_time, time_setting, latest_hack_time "
+            "language_code, start_time, time_setting, latest_hack_time, utc_offset "
             "FROM user LEFT OUTER JOIN latest_hack "
             "ON user.user_id=latest_hack.user_id"
         ):
@@ -88,31 +151,104 @@ class HackBot(BotPlugin):
                 if user[0] != 70166446:
                     continue
             self.users[user[0]] = HackUser(*user)
-            self.setup_timer(user[0])
+            self.join_cohort(user[0], arm=False)
+        self.start_cohorts(list(self.cohorts.values()))
+        self.refill_timer = self.scheduler.enter(REFILL_INTERVAL, 1, self.refill)
+
+    def start(self):
+        self.db.start()
 
-    def setup_timer(self, user_id):
+    async def stop(self):
+        await self.db.close()
+
+    def join_cohort(self, user_id, arm=True):
         u = self.users[user_id]
         if u.start_time < 0:
             return
-        next_day = previous_day_start(u.start_time) + DAY_SECONDS
-        if u.timer_setting is None:
-            timer_setting = time_remain
-        else:
-            timer_setting = u.timer_setting
-        for i, delay in enumerate(timer_setting):
-            if next_day - delay > time.time():
-                u.timers.append(
-                    self.scheduler.enterabs(
-                        next_day - delay, 3, self.timer_fired, argument=(user_id, i)
-                    )
-                )
-                break
-
-        u.main_timer = self.scheduler.enterabs(
-            next_day, 2, self.new_day, argument=[user_id]
+        key = u.cohort_key
+        cohort = self.cohorts.get(key)
+        if cohort is None:
+            cohort = self.cohorts[key] = Cohort(key)
+            if arm:
+                self.start_cohort(cohort)
+        cohort.members.add(user_id)
+
+    def leave_cohort(self, user_id):
+        u = self.users[user_id]
+        # The scheduler indexes the 36h emergency chain by user; daily
+        # timers belong to the cohort
+        self.scheduler.cancel_owner(user_id)
+        cohort = self.cohorts.get(u.cohort_key)
+        if cohort is None:
+            return
+        cohort.members.discard(user_id)
+        if not cohort.members:
+            self.cancel_timer(cohort)
+            del self.cohorts[cohort.key]
+
+    def cancel_timer(self, cohort: Cohort):
+        if cohort.timer is not None:
+            self.scheduler.cancel(cohort.timer)
+            cohort.timer = None
+        if cohort.main_timer is not None:
+            self.scheduler.cancel(cohort.main_timer)
+            cohort.main_timer = None
+        # A stale entry in self.deferred is skipped by refill()
+        cohort.deferred = None
+
+    def start_cohort(self, cohort: Cohort):
+        self.start_cohorts([cohort])
+
+    def start_cohorts(self, cohorts: List[Cohort]):
+        """Enter the new_day events and arm the timers of cohorts.
+
+        The next day and first reminder of every cohort are computed in
+        one fire_times pass, and the events entered in one batch.
+        """
+        now = self.now()
+        next_days, times, indexes = fire_times.next_fire_times(
+            [c.start_time for c in cohorts], [c.timer_setting for c in cohorts], now
+        )
+        main_timers = self.scheduler.enterabs_many(
+            next_days, 2, self.new_day, [(c.key,) for c in cohorts], interval=DAY_SECONDS
+        )
+        for cohort, event in zip(cohorts, main_timers):
+            cohort.main_timer = event
+        self._arm(cohorts, times, indexes, now)
+
+    def arm_timer(self, cohort: Cohort):
+        """Schedule the first reminder of the day still to come."""
+        self.arm_timers([cohort])
+
+    def arm_timers(self, cohorts: List[Cohort]):
+        now = self.now()
+        _, times, indexes = fire_times.next_fire_times(
+            [c.start_time for c in cohorts], [c.timer_setting for c in cohorts], now
+        )
+        self._arm(cohorts, times, indexes, now)
+
+    def _arm(self, cohorts: List[Cohort], times, indexes, now):
+        armed = []
+        horizon = now + HORIZON
+        deferred = self.deferred
+        for cohort, fire_time, i in zip(cohorts, times, indexes):
+            if fire_time is None:
+                continue  # new_day arms the chain of the next day
+            if fire_time >= horizon:
+                cohort.deferred = fire_time
+                heapq.heappush(deferred, (fire_time, cohort.key))
+            else:
+                armed.append((cohort, fire_time, i))
+        events = self.scheduler.enterabs_many(
+            [fire_time for _, fire_time, _ in armed],
+            3,
+            self.timer_fired,
+            [(cohort.key, i) for cohort, _, i in armed],
         )
+        for (cohort, _, _), event in zip(armed, events):
+            cohort.timer = event
 
-    def add_user(self, user: telegram.User, start_time):
+    def add_user(self, user: telegram.User, start_time, utc_offset=None):
         self.users[user.id] = HackUser(
             user.id,
             user.username,
@@ -122,10 +258,12 @@ class HackBot(BotPlugin):
             start_time,
             None,
             None,
+            utc_offset,
         )
 
         self.db.execute(
-            "INSERT INTO user VALUES (?,?,?,?,?,?, NULL)",
+            "INSERT INTO user(user_id, username, first_name, last_name, language_code, start_time, utc_offset) "
+            "VALUES (?,?,?,?,?,?,?)",
             (
                 user.id,
                 user.username,
@@ -133,21 +271,16 @@ class HackBot(BotPlugin):
                 user.last_name,
                 user.language_code,
                 start_time,
+                utc_offset,
             ),
         )
-        self.db.commit()
 
-        self.setup_timer(user.id)
+        self.join_cohort(user.id)
 
     def change_time(self, user: telegram.User, start_time):
         u = self.users[user.id]
         u.last_hack_time = None
-        for event in u.timers:
-            self.scheduler.cancel(event)
-        u.timers = []
-        if u.main_timer is not None:
-            self.scheduler.cancel(u.main_timer)
-            u.main_timer = None
+        self.leave_cohort(user.id)
 
         u.start_time = start_time
         self.db.execute(
@@ -167,7 +300,6 @@ class HackBot(BotPlugin):
                 user.id,
             ),
         )
-        self.db.commit()
         if start_time >= 0:
             if u.timer_setting is not None:
                 new_setting = [
@@ -175,20 +307,15 @@ class HackBot(BotPlugin):
                     for x in u.timer_setting
                 ]
                 new_setting.sort(reverse=True)
-                u.timer_setting = new_setting
+                u.timer_setting = intern_setting(new_setting)
 
-        self.setup_timer(user.id)
+        self.join_cohort(user.id)
 
     def change_time_setting(self, user: telegram.User, time_setting):
         u = self.users[user.id]
-        for event in u.timers:
-            self.scheduler.cancel(event)
-        u.timers = []
-        if u.main_timer is not None:
-            self.scheduler.cancel(u.main_timer)
-            u.main_timer = None
-
-        u.timer_setting = time_setting
+        self.leave_cohort(user.id)
+
+        u.timer_setting = intern_setting(time_setting) if time_setting is not None else None
         if time_setting is not None:
             time_setting_str = " ".join([str(x) for x in time_setting])
         else:
@@ -210,8 +337,14 @@ class HackBot(BotPlugin):
                 user.id,
             ),
         )
-        self.db.commit()
-        self.setup_timer(user.id)
+        self.join_cohort(user.id)
+
+    def change_zone(self, user: telegram.User, utc_offset: int):
+        # Times are kept in UTC, so only parsing and display change
+        self.users[user.id].zone = time_zone(utc_offset)
+        self.db.execute(
+            "UPDATE user SET utc_offset=? WHERE user_id=?", (utc_offset, user.id)
+        )
 
     def add_record(self, user_id, date):
         if self.users.get(user_id) is None:
@@ -222,19 +355,19 @@ class HackBot(BotPlugin):
         ):
             self.users[user_id].last_hack_time = date
             self.db.execute("INSERT INTO hack_record VALUES (?,?)", (user_id, date))
-            self.db.commit()
 
-    def handle_command(
+    async def handle_command(
         self, user: telegram.User, chat: telegram.Chat, parameters: List[str]
     ):
         if len(parameters) == 0:
             return (
-                '<code>/hack start hh:mm</code>  set the start point of each "hack" day (UTC+8)\n'
+                '<code>/hack start hh:mm</code>  set the start point of each "hack" day ({})\n'
                 "<code>/hack status</code>       list all following timers\n"
                 "<code>/hack alarm hh:mm hh:mm ...</code>      set time for notifications \n"
                 "<code>/hack stop</code>      stop notifications \n"
                 "<code>/hack record hh:mm</code>      record hack time in previous day \n"
-            )
+                "<code>/hack zone +hh:mm</code>      set your time zone \n"
+            ).format(self.zone_of(user.id).name)
         if parameters[0] == "start":
             return self._handle_start(parameters, user)
         if parameters[0] == "status":
@@ -245,28 +378,31 @@ class HackBot(BotPlugin):
             return self._handle_stop(parameters, user)
         if parameters[0] == "record":
             return self._handle_record(parameters, user)
+        if parameters[0] == "zone":
+            return self._handle_zone(parameters, user)
         return ""
 
+    def zone_of(self, user_id) -> TimeZone:
+        u = self.users.get(user_id)
+        return u.zone if u is not None else time_zone()
+
     def _handle_record(self, parameters: List[str], user: telegram.User):
         if self.users.get(user.id) is None:
             return "Please set day start time first"
         u = self.users[user.id]
         if len(parameters) != 2:
-            return "Format error! Please provide hack times. Format: \nhh:mm in UTC+8"
+            return "Format error! Please provide hack times. Format: \nhh:mm in " + u.zone.name
         s = parameters[1]
         r = re.search("(\\d{1,2}):(\\d{1,2})", s)
         if r is None:
-            return "Format error! Please provide hack times. Format: \nhh:mm in UTC+8"
-        h = int(r.group(1))
-        h = (h + 16) % 24
-        m = int(r.group(2))
-        new_time = (h * 60 + m) * 60
-        t = previous_day_start(u.start_time) + new_time
+            return "Format error! Please provide hack times. Format: \nhh:mm in " + u.zone.name
+        new_time = u.zone.from_local(int(r.group(1)), int(r.group(2)))
+        t = self.day_start(u.start_time) + new_time
         self.add_record(user.id, t)
 
     def _handle_stop(self, parameters: List[str], user: telegram.User):
         if self.users.get(user.id) is not None:
-            if self.users[user.id].start_time > 0:
+            if self.users[user.id].start_time >= 0:
                 self.change_time(user, -1)
                 return "Timers removed."
         return "You haven't set up the timer."
@@ -274,75 +410,99 @@ class HackBot(BotPlugin):
     def _handle_alarm(self, parameters: List[str], user: telegram.User):
         if self.users.get(user.id) is None:
             return "Please set day start time first"
+        u = self.users[user.id]
         if len(parameters) == 1:
             return escape(
-                "Please provide alarm times. Format: \nhh:mm <hh:mm> <hh:mm>... in UTC+8"
+                "Please provide alarm times. Format: \nhh:mm <hh:mm> <hh:mm>... in "
+                + u.zone.name
             )
         if parameters[1] == "reset":
             self.change_time_setting(user, None)
             return "Alarms reset to default."
-        u = self.users[user.id]
         setting = []
         for s in parameters[1:]:
             r = re.search("(\\d{1,2}):(\\d{1,2})", s)
             if r is None:
                 return escape(
-                    "Format error! Please provide alarm times. Format: \nhh:mm <hh:mm> <hh:mm>... in UTC+8"
+                    "Format error! Please provide alarm times. Format: \nhh:mm <hh:mm> <hh:mm>... in "
+                    + u.zone.name
                 )
-            h = int(r.group(1))
-            h = (h + 16) % 24
-            m = int(r.group(2))
-            new_time = (h * 60 + m) * 60
+            new_time = u.zone.from_local(int(r.group(1)), int(r.group(2)))
             new_time = (u.start_time - new_time + DAY_SECONDS) % DAY_SECONDS
             setting.append(new_time)
         setting.sort(reverse=True)
         self.change_time_setting(user, setting)
         reply = "You will receive notification at:\n" + "\n".join(
-            [day_time_to_str(u.start_time - x) for x in setting]
+            [u.zone.day_time(u.start_time - x) for x in setting]
         )
         return reply
 
-    def _handle_status(self, parameters: List[str], user: telegram.User):
+    def _handle_zone(self, parameters: List[str], user: telegram.User):
+        if len(parameters) != 2:
+            return "Your time zone is {}. Format: +hh:mm or -hh:mm".format(self.zone_of(user.id).name)
+        utc_offset = parse_utc_offset(parameters[1])
+        if utc_offset is None:
+            return "Format error! Please provide your offset from UTC. Format: +hh:mm or -hh:mm"
         if self.users.get(user.id) is None:
-            return "No timer is set"
+            # Without timers until /hack start, which is then read in this zone
+            self.add_user(user, -1, utc_offset)
+        else:
+            self.change_zone(user, utc_offset)
         u = self.users[user.id]
-        reply = "Current timers:\n"
+        reply = "Time zone set to {}.".format(u.zone.name)
+        if u.start_time >= 0:
+            reply += " Your day starts at {}.".format(u.zone.day_time(u.start_time))
+        else:
+            reply += " Set your day start time with /hack start hh:mm."
+        return reply
+
+    def _handle_status(self, parameters: List[str], user: telegram.User):
+        u = self.users.get(user.id)
+        # start_time -1: stopped, or only a time zone was set
+        if u is None or u.start_time < 0:
+            return "No timer is set"
+        clock = u.zone.day_time
         if u.timer_setting is not None:
             setting = u.timer_setting
         else:
-            setting = time_remain
-        i = 0
-        for x in u.timers:
-            while x.argument[1] > i:
-                reply += "{} (past)\n".format(
-                    day_time_to_str(u.start_time - setting[i])
-                )
-                i += 1
-            reply += "{} (set)\n".format(day_time_to_str(u.start_time - setting[i]))
-        i += 1
-        for j in range(i, len(setting)):
-            reply += "{} (will set)\n".format(
-                day_time_to_str(u.start_time - setting[j])
-            )
-        reply += "{} (next day)\n".format(day_time_to_str(u.start_time))
-        return reply
+            setting = DEFAULT_SETTING
+        cohort = self.cohorts.get(u.cohort_key)
+        armed = cohort.timer.argument[1] if cohort is not None and cohort.timer is not None else None
+        next_day = self.day_start(u.start_time) + DAY_SECONDS
+        now = self.now()
+        lines = ["Current timers:"]
+        for i, delay in enumerate(setting):
+            if next_day - delay <= now:
+                state = " (past)"
+            elif i == armed:
+                state = " (set)"
+            else:
+                state = " (will set)"
+            lines.append(clock(u.start_time - delay) + state)
+        lines.append(clock(u.start_time) + " (next day)")
+        emergency = self.scheduler.next_for(user.id)
+        if emergency is not None:
+            lines.append(clock(emergency.time) + " (36h reminder)")
+        lines.append("")
+        return "\n".join(lines)
 
     def _handle_start(self, parameters: List[str], user: telegram.User):
+        zone = self.zone_of(user.id)
         if len(parameters) != 2:
-            return "Please set time. Format: hh:mm in UTC+8"
+            return "Please set time. Format: hh:mm in " + zone.name
         start = parameters[1]
         r = re.search("(\\d{1,2}):(\\d{1,2})", start)
         if r is None:
-            return "Format error! Please set time. Format: hh:mm in UTC+8"
-        h = int(r.group(1))
-        h = (h + 16) % 24
-        m = int(r.group(2))
-        if self.users.get(user.id) is not None:
-            self.change_time(user, (h * 60 + m) * 60)
-            return "Changed"
-        else:
-            self.add_user(user, (h * 60 + m) * 60)
+            return "Format error! Please set time. Format: hh:mm in " + zone.name
+        start_time = zone.from_local(int(r.group(1)), int(r.group(2)))
+        u = self.users.get(user.id)
+        if u is None:
+            self.add_user(user, start_time)
             return "Set"
+        # Stopped, or only a time zone was set: nothing to change
+        new = u.start_time < 0
+        self.change_time(user, start_time)
+        return "Set" if new else "Changed"
 
     async def handle_callback(self, callback: telegram.CallbackQuery):
         user_id = callback.from_user.id
@@ -354,51 +514,59 @@ class HackBot(BotPlugin):
             return "Error Callback Data", True
         if user_id != target_user_id:
             return "This is not your timer", True
-        t = time.time()
+        t = self.now()
         if self.users.get(user_id) is None:
             return "You haven't setup the starting point", True
         self.add_record(user_id, t)
         if callback.message is not None:
-            button = telegram.InlineKeyboardButton(
-                "Portal hacked", callback_data=self.prefix + str(user_id)
-            )
             if callback.message.is_accessible:
-                await self.bot.edit_message_text(
-                    text="Portal hacked at {}".format(timestamp_to_str(t)),
+                await self.outbox.edit_message_text(
+                    text="Portal hacked at {}".format(self.users[user_id].zone.timestamp(t)),
                     chat_id=callback.message.chat.id,
                     message_id=callback.message.message_id,
-                    reply_markup=telegram.InlineKeyboardMarkup([[button]]),
+                    reply_markup=self.markup(user_id),
                 )
-            self.users[user_id].message_records = []
+            self.users[user_id].message_records = None
 
         return "Hack time recorded", False
 
-    async def new_day(self, user_id, **kwargs):
-        logging.debug("new day: {}".format(timestamp_to_str(kwargs["event"].time)))
+    async def refill(self, **kwargs):
+        """Materialize the timers of deferred cohorts due within HORIZON."""
+        self.refill_timer = self.scheduler.enter(REFILL_INTERVAL, 1, self.refill)
+        horizon = self.now() + HORIZON
+        deferred = self.deferred
+        due = []
+        while deferred and deferred[0][0] < horizon:
+            fire_time, key = heapq.heappop(deferred)
+            cohort = self.cohorts.get(key)
+            if cohort is None or cohort.deferred != fire_time:
+                continue
+            cohort.deferred = None
+            due.append(cohort)
+        self.arm_timers(due)
+
+    async def new_day(self, key: CohortKey, **kwargs):
+        debug_time("new day: %s", kwargs["event"].time)
+        cohort = self.cohorts.get(key)
+        # Its last member left (and maybe a new cohort took its key) after
+        # the event was dispatched
+        if cohort is None or cohort.main_timer is not kwargs["event"]:
+            return
+        if cohort.timer is not None:
+            self.scheduler.cancel(cohort.timer)
+            cohort.timer = None
+        cohort.deferred = None
+        self.arm_timer(cohort)
+        await asyncio.gather(*[self.greet(user_id) for user_id in list(cohort.members)])
+
+    async def greet(self, user_id):
         u = self.users[user_id]
-
-        for event in u.timers:
-            self.scheduler.cancel(event)
-        u.timers = []
+        self.scheduler.cancel_owner(user_id)
 
         start_time = u.start_time
-        previous_day = previous_day_start(start_time)
-        next_day = previous_day + DAY_SECONDS
-        u.main_timer = self.scheduler.enterabs(
-            next_day, 2, self.new_day, argument=[user_id]
-        )
+        previous_day = self.day_start(start_time)
 
         hacked_too_early = False
-        if u.timer_setting is not None:
-            delay = u.timer_setting[0]
-        else:
-            delay = time_remain[0]
-        u.timers.append(
-            self.scheduler.enterabs(
-                next_day - delay, 3, self.timer_fired, argument=(user_id, 0)
-            )
-        )
-
         last_hack_time = u.last_hack_time
         if (
             last_hack_time is not None
@@ -409,95 +577,138 @@ class HackBot(BotPlugin):
             hacked_too_early = True
             for i, delay in enumerate(emergency_remain):
                 if last_hack_time + delay > start_time:
-                    u.timers.append(
-                        self.scheduler.enterabs(
-                            last_hack_time + 36 * HOUR_SECONDS - emergency_remain[0],
-                            3,
-                            self.timer_fired,
-                            argument=(user_id, -1),
-                        )
+                    self.scheduler.enterabs(
+                        last_hack_time + 36 * HOUR_SECONDS - emergency_remain[0],
+                        3,
+                        self.emergency_fired,
+                        argument=(user_id, -1),
+                        owner=user_id,
                     )
                     break
 
-        button = telegram.InlineKeyboardButton(
-            "Portal hacked", callback_data=self.prefix + str(user_id)
-        )
-
         text_message = (
             "Hello {}! Yet another day! Please remember to hack a portal today!".format(
-                self.users[user_id].name
+                u.name
             )
         )
         if hacked_too_early:
             text_message += "\nYour previous hack is too early. Please remember to hack a portal within 36h after previous hack!"
         try:
-            message = await self.bot.send_message(
+            message = await self.outbox.send_message(
                 user_id,
                 text_message,
-                reply_markup=telegram.InlineKeyboardMarkup([[button]]),
+                reply_markup=self.markup(user_id),
             )
-            u.message_records.append((message.chat_id, message.message_id))
+            self.remember_message(u, (message.chat_id, message.message_id))
         except telegram.error.TelegramError:
             pass
 
-    async def timer_fired(self, user_id, seq, **kwargs):
-        logging.debug("fire time: {}".format(timestamp_to_str(kwargs["event"].time)))
-        u = self.users[user_id]
-        u.timers.remove(kwargs["event"])
+    async def timer_fired(self, key: CohortKey, seq, **kwargs):
+        debug_time("fire time: %s", kwargs["event"].time)
+        cohort = self.cohorts.get(key)
+        if cohort is None or cohort.timer is not kwargs["event"]:
+            return
+        cohort.timer = None
+
+        current_day = self.day_start(cohort.start_time)
+        setting = cohort.timer_setting
+        if seq + 1 < len(setting):
+            cohort.timer = self.scheduler.enterabs(
+                current_day + DAY_SECONDS - setting[seq + 1],
+                3,
+                self.timer_fired,
+                argument=(key, seq + 1),
+            )
 
-        start_time = u.start_time
-        current_day = previous_day_start(start_time)
+        msg = cohort.texts[seq]
+        users = self.users
+        await asyncio.gather(
+            *[
+                self.remind(user_id, msg)
+                for user_id in list(cohort.members)
+                if users[user_id].last_hack_time is None
+                or users[user_id].last_hack_time <= current_day
+            ]
+        )
+
+    async def emergency_fired(self, user_id, seq, **kwargs):
+        debug_time("fire time: %s", kwargs["event"].time)
+        u = self.users[user_id]
 
-        if u.last_hack_time is not None and u.last_hack_time > current_day:
+        current_day = self.day_start(u.start_time)
+        if u.last_hack_time is None or u.last_hack_time > current_day:
             return
 
-        if seq < 0 and u.last_hack_time is not None:
-            seq = -seq - 1
-            delay = emergency_remain[seq]
-            msg = thirty_six_template.format(time_interval_to_remain(delay))
-            if seq + 1 < len(emergency_remain):
-                u.timers.append(
-                    self.scheduler.enterabs(
-                        u.last_hack_time
-                        + 36 * HOUR_SECONDS
-                        - emergency_remain[seq + 1],
-                        3,
-                        self.timer_fired,
-                        argument=(user_id, -seq - 2),
-                    )
-                )
+        seq = -seq - 1
+        msg = EMERGENCY_TEXTS[seq]
+        if seq + 1 < len(emergency_remain):
+            self.scheduler.enterabs(
+                u.last_hack_time + 36 * HOUR_SECONDS - emergency_remain[seq + 1],
+                3,
+                self.emergency_fired,
+                argument=(user_id, -seq - 2),
+                owner=user_id,
+            )
+        await self.remind(user_id, msg)
+
+    def markup(self, user_id) -> telegram.InlineKeyboardMarkup:
+        """The "Portal hacked" keyboard for user_id, built once and cached."""
+        markup = self.markups.get(user_id)
+        if markup is None:
+            button = telegram.InlineKeyboardButton(
+                "Portal hacked", callback_data=self.prefix + str(user_id)
+            )
+            markup = self.markups[user_id] = telegram.InlineKeyboardMarkup([[button]])
+        return markup
 
+    @staticmethod
+    def remember_message(u: HackUser, record: Tuple[int, int]):
+        if u.message_records is None:
+            u.message_records = [record]
         else:
-            if u.timer_setting is None:
-                setting = time_remain
-            else:
-                setting = u.timer_setting
-            delay = setting[seq]
-            msg = time_remain_template.format(time_interval_to_remain(delay))
-            if seq + 1 < len(setting):
-                u.timers.append(
-                    self.scheduler.enterabs(
-                        current_day + DAY_SECONDS - setting[seq + 1],
-                        3,
-                        self.timer_fired,
-                        argument=(user_id, seq + 1),
-                    )
-                )
+            u.message_records.append(record)
 
-        button = telegram.InlineKeyboardButton(
-            "Portal hacked", callback_data=self.prefix + str(user_id)
-        )
+    async def remind(self, user_id, msg):
+        """Send a reminder and delete the previous ones.
+
+        In live message mode the latest message is edited into the
+        reminder instead, which takes one call instead of 1 + N.  A new
+        message is only sent when the edit fails, e.g. because the user
+        deleted it.  Telegram does not notify users of edits.
+        """
+        u = self.users[user_id]
+        if self.live_message and u.message_records:
+            chat_id, message_id = u.message_records[-1]
+            try:
+                await self.outbox.edit_message_text(
+                    msg, chat_id, message_id, priority=BULK, reply_markup=self.markup(user_id)
+                )
+            except telegram.error.TelegramError:
+                pass
+            else:
+                records = u.message_records
+                if records and len(records) > 1:
+                    u.message_records = [records[-1]]
+                    await self.delete_messages(records[:-1])
+                return
         try:
-            message = await self.bot.send_message(
-                user_id, msg, reply_markup=telegram.InlineKeyboardMarkup([[button]])
+            message = await self.outbox.send_message(
+                user_id, msg, reply_markup=self.markup(user_id)
             )
         except telegram.error.TelegramError:
             return
-        if len(u.message_records) > 0:
-            for i in u.message_records:
-                try:
-                    await self.bot.delete_message(i[0], i[1])
-                except telegram.error.TelegramError:
-                    pass
-            u.message_records = []
-        u.message_records.append((message.chat_id, message.message_id))
+        records = u.message_records
+        u.message_records = None
+        self.remember_message(u, (message.chat_id, message.message_id))
+        if records:
+            await self.delete_messages(records)
+
+    async def delete_messages(self, records: List[Tuple[int, int]]):
+        """Delete messages concurrently, ignoring the ones that are gone."""
+        results = await asyncio.gather(
+            *[self.outbox.delete_message(chat_id, message_id) for chat_id, message_id in records],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, telegram.error.TelegramError):
+                raise result
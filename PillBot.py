@@ -1,10 +1,8 @@
-import logging
 import re
-import sqlite3
-import threading
 from html import escape
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
+import persistence
 import sched_cond
 from BotPlugin import *
 
@@ -19,7 +17,12 @@ from BotPlugin import *
 ## Action: text on button
 
 
+_missing = object()
+
+
 class PillRecord:
+    __slots__ = ("user_id", "chat_id", "alarm_time", "description", "timer")
+
     def __init__(self, user_id: int, chat_id: int, alarm_time, description):
         self.user_id = user_id
         self.chat_id = chat_id
@@ -30,75 +33,121 @@ class PillRecord:
 
 class PillBot(BotPlugin):
     prefix = "pill"
+    commands = frozenset(("add", "list", "del", "zone"))
 
-    def __init__(self, bot: telegram.Bot):
-        super().__init__(bot)
-        self.db = sqlite3.connect("data/pill_data.sqlite", check_same_thread=False)
-        self.scheduler = sched_cond.scheduler_condition(timefunc=time.time, delayfunc=time.sleep)
-        threading.Thread(target=self.scheduler.run).start()
+    def __init__(self, bot: telegram.Bot, scheduler: sched_cond.scheduler_condition, outbox: Outbox,
+                 user_cache_size: int = 65536):
+        super().__init__(bot, scheduler, outbox)
+        self.db = persistence.WriteBehindDB("data/pill_data.sqlite")
         self.records: Dict[int, PillRecord] = dict()
-        self.users: Dict[int, User] = dict()
+        # Ids of the records of a user, in total and per chat, in
+        # increasing order; tuples since most users have one or two
+        self.by_user: Dict[int, Tuple[int, ...]] = dict()
+        self.by_user_chat: Dict[Tuple[int, int], Tuple[int, ...]] = dict()
+        # user_id -> User, or None for users known to be missing from the database
+        self.users = LRUCache(user_cache_size)
+        self.next_record_id = self.db.query("SELECT coalesce(max(id), 0) + 1 FROM pill_record").fetchone()[0]
+        # Minutes east of UTC, NULL for DEFAULT_UTC_OFFSET
+        self.db.add_column("user", "utc_offset", "INTEGER")
 
-        for record in self.db.execute("SELECT id, user_id, chat_id, alarm_time, description FROM pill_record"):
+        for row in self.db.query(
+                "SELECT pill_record.id, pill_record.user_id, chat_id, alarm_time, description, "
+                "user.user_id, username, first_name, last_name, language_code, utc_offset "
+                "FROM pill_record LEFT OUTER JOIN user ON pill_record.user_id = user.user_id"):
             if DEBUG:
-                if record[1] != 70166446:
+                if row[1] != 70166446:
                     continue
-            user = self.db.execute(
-                "SELECT user_id, username, first_name, last_name, language_code FROM main.user WHERE user_id = ?",
-                [record[1]]).fetchone()
-            self.users[record[1]] = User(*user)
-            self.records[record[0]] = PillRecord(*record[1:])
-            self.setup_timer(record[0])
-
-        new_day = previous_day_start(0) + DAY_SECONDS
-        self.main_timer = self.scheduler.enterabs(new_day, 1, self.new_day)
-
-    async def new_day(self, **kwargs):
-        logging.debug("new day: {}".format(timestamp_to_str(time.time())))
-        new_day = previous_day_start(0) + DAY_SECONDS
-        self.main_timer = self.scheduler.enterabs(new_day, 1, self.new_day)
-
-        for record_id in self.records:
-            self.setup_timer(record_id)
+            if row[5] is not None and row[5] not in self.users:
+                self.users[row[5]] = User(*row[5:])
+            self.records[row[0]] = PillRecord(*row[1:5])
+            self.index_record(row[0])
+            self.setup_timer(row[0])
+
+    def start(self):
+        self.db.start()
+
+    async def stop(self):
+        await self.db.close()
+
+    def index_record(self, record_id):
+        # Ids only grow, so appending keeps the tuples sorted
+        r = self.records[record_id]
+        self.by_user[r.user_id] = self.by_user.get(r.user_id, ()) + (record_id,)
+        key = (r.user_id, r.chat_id)
+        self.by_user_chat[key] = self.by_user_chat.get(key, ()) + (record_id,)
+
+    def unindex_record(self, record_id, r: PillRecord):
+        for index, key in ((self.by_user, r.user_id), (self.by_user_chat, (r.user_id, r.chat_id))):
+            ids = tuple(i for i in index.get(key, ()) if i != record_id)
+            if ids:
+                index[key] = ids
+            else:
+                index.pop(key, None)
 
     def setup_timer(self, record_id):
         r = self.records[record_id]
+        if r.timer is not None:
+            self.scheduler.cancel(r.timer)
+            r.timer = None
         if r.alarm_time < 0:
             return
-        alarm_time = r.alarm_time
-        day_start = previous_day_start(0)
-        if day_start + alarm_time < time.time():
-            return
-        r.timer = self.scheduler.enterabs(day_start + alarm_time, 3, self.timer_fired, argument=[record_id])
+        alarm_time = self.day_start(0) + r.alarm_time
+        if alarm_time < self.now():
+            alarm_time += DAY_SECONDS
+        r.timer = self.scheduler.enterabs(alarm_time, 3, self.timer_fired, argument=(record_id,),
+                                          owner=r.user_id, interval=DAY_SECONDS)
 
-    def update_user(self, user: telegram.User):
+    async def update_user(self, user: telegram.User) -> User:
+        u = await self._load_user(user.id)
+        if u is None:
+            u = self.users[user.id] = User(user.id, user.username, user.first_name, user.last_name,
+                                           user.language_code)
+        else:
+            u.username, u.first_name, u.last_name = user.username, user.first_name, user.last_name
+            u.language_code = user.language_code
+        # Leaves utc_offset alone
         self.db.execute(
-            "INSERT OR REPLACE INTO user VALUES (?,?,?,?,?)",
+            "INSERT INTO user(user_id, username, first_name, last_name, language_code) VALUES (?,?,?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, "
+            "last_name=excluded.last_name, language_code=excluded.language_code",
             (user.id, user.username, user.first_name, user.last_name, user.language_code)
         )
+        return u
 
-    def get_user(self, user_id):
-        u = self.users.get(user_id)
-        if u is None:
-            user = self.db.execute("SELECT * FROM main.user WHERE user_id = ?", [user_id]).fetchone()
+    async def change_zone(self, user: telegram.User, utc_offset: int):
+        u = await self.update_user(user)
+        u.zone = time_zone(utc_offset)
+        self.db.execute("UPDATE user SET utc_offset=? WHERE user_id=?", (utc_offset, user.id))
 
-            if user is None:
-                return User(user_id, str(user_id), "", "", "")
-            else:
-                self.users[user_id] = User(*user)
-                return self.users[user_id]
+    def _query_user(self, user_id):
+        return self.db.query(
+            "SELECT user_id, username, first_name, last_name, language_code, utc_offset "
+            "FROM main.user WHERE user_id = ?",
+            [user_id]).fetchone()
+
+    async def _load_user(self, user_id) -> Optional[User]:
+        """The cached user, read from the database on a miss; None if unknown."""
+        u = self.users.get(user_id, _missing)
+        if u is _missing:
+            user = await self.run_blocking(self._query_user, user_id)
+            u = self.users[user_id] = User(*user) if user is not None else None
+        return u
+
+    async def get_user(self, user_id):
+        u = await self._load_user(user_id)
+        if u is None:
+            return User(user_id, str(user_id), "", "", "")
         return u
 
     def add_record(self, user_id: int, chat_id: int, alarm_time: int, description: str):
-        cursor = self.db.cursor()
-        cursor.execute("INSERT INTO pill_record(user_id, chat_id, alarm_time, description) VALUES (?,?,?,?)",
-                       (user_id, chat_id, alarm_time, description))
-        record_id = cursor.lastrowid
-        self.db.commit()
-        if record_id is None:
-            return -1
+        # Ids are allocated here so that the insert can be written behind
+        record_id = self.next_record_id
+        self.next_record_id += 1
+        self.db.execute("INSERT INTO pill_record(id, user_id, chat_id, alarm_time, description) VALUES (?,?,?,?,?)",
+                        (record_id, user_id, chat_id, alarm_time, description))
 
         self.records[record_id] = PillRecord(user_id, chat_id, alarm_time, description)
+        self.index_record(record_id)
         self.setup_timer(record_id)
         return record_id
 
@@ -106,8 +155,12 @@ class PillBot(BotPlugin):
         self.db.execute(
             "DELETE FROM pill_record WHERE id = ?", [record_id]
         )
-        self.db.commit()
-        self.records.pop(record_id, None)
+        r = self.records.pop(record_id, None)
+        if r is None:
+            return
+        self.unindex_record(record_id, r)
+        if r.timer is not None:
+            self.scheduler.cancel(r.timer)
 
     def set_record_time(self, record_id, alarm_time):
         if alarm_time is not None:
@@ -116,8 +169,8 @@ class PillBot(BotPlugin):
                 "SET alarm_time=?"
                 "WHERE id=?",
                 (alarm_time, record_id))
-            self.db.commit()
             self.records[record_id].alarm_time = alarm_time
+            self.setup_timer(record_id)
 
     def set_record_description(self, record_id, description):
         self.db.execute(
@@ -125,48 +178,44 @@ class PillBot(BotPlugin):
             "SET description=?"
             "WHERE id=?",
             (description, record_id))
-        self.db.commit()
         self.records[record_id].description = description
 
-    def handle_command(self, user: telegram.User, chat: telegram.Chat, parameters: List[str]):
+    async def handle_command(self, user: telegram.User, chat: telegram.Chat, parameters: List[str]):
         if len(parameters) == 0:
-            return "<code>/pill add hh:mm [description]</code>  set the notification time (UTC+8)\n" \
+            zone = (await self.get_user(user.id)).zone
+            return "<code>/pill add hh:mm [description]</code>  set the notification time ({})\n" \
                    "<code>/pill list</code>       list all timers\n" \
                    "<code>/pill del record_id</code>      set time for notifications \n" \
                    "<code>/pill settime record_id hh:mm</code>\n" \
-                   "<code>/pill setdes record_id [description]</code>"
+                   "<code>/pill setdes record_id [description]</code>\n" \
+                   "<code>/pill zone +hh:mm</code>      set your time zone".format(zone.name)
 
         if parameters[0] == "add":
+            zone = (await self.get_user(user.id)).zone
             if len(parameters) < 2:
-                return "Please set time. Format: hh:mm in UTC+8"
+                return "Please set time. Format: hh:mm in " + zone.name
             start = parameters[1]
             r = re.search("(\\d{1,2}):(\\d{1,2})", start)
             if r is None:
-                return "Format error! Please set time. Format: hh:mm in UTC+8"
-            h = int(r.group(1))
-            h = (h + 16) % 24
-            m = int(r.group(2))
+                return "Format error! Please set time. Format: hh:mm in " + zone.name
+            alarm_time = zone.from_local(int(r.group(1)), int(r.group(2)))
             if len(parameters) == 2:
                 description = None
             else:
                 description = escape(" ".join(parameters[2:]))
-            self.update_user(user)
-            self.add_record(user.id, chat.id, (h * 60 + m) * 60, description or "")
+            await self.update_user(user)
+            self.add_record(user.id, chat.id, alarm_time, description or "")
             return "Added"
         if parameters[0] == "list":
-            reply = ""
             if chat.id == user.id:
-                for i in self.records:
-                    if self.records[i].user_id == user.id:
-                        reply += "<code>{:03}</code> <code>{}</code>  {}\n".format(i, day_time_to_str(
-                            self.records[i].alarm_time),
-                                                                                   self.records[i].description)
+                ids = self.by_user.get(user.id, ())
             else:
-                for i in self.records:
-                    if self.records[i].user_id == user.id and self.records[i].chat_id == chat.id:
-                        reply += "<code>{:03}</code> <code>{}</code>  {}\n".format(i, day_time_to_str(
-                            self.records[i].alarm_time),
-                                                                                   self.records[i].description)
+                ids = self.by_user_chat.get((user.id, chat.id), ())
+            clock = (await self.get_user(user.id)).zone.day_time
+            reply = "".join(
+                "<code>{:03}</code> <code>{}</code>  {}\n".format(i, clock(self.records[i].alarm_time),
+                                                                 self.records[i].description)
+                for i in ids)
             if reply == "":
                 return "Not found"
             return "You have following timers:\n" + reply
@@ -204,14 +253,21 @@ class PillBot(BotPlugin):
                 record_id = int(parameters[1])
             except ValueError:
                 return "Please provide valid record id"
-            self.update_user(user)
-            if self.records.get(record_id) is not None:
-                record = self.records[record_id]
-                if record.user_id != user.id:
-                    return "This is not your timer"
+            await self.update_user(user)
+            if record_id in self.by_user.get(user.id, ()):
                 self.remove_record(record_id)
                 return "Removed!"
+            if record_id in self.records:
+                return "This is not your timer"
             return "You haven't set up the timer."
+        if parameters[0] == "zone":
+            if len(parameters) != 2:
+                return "Your time zone is {}. Format: +hh:mm or -hh:mm".format((await self.get_user(user.id)).zone.name)
+            utc_offset = parse_utc_offset(parameters[1])
+            if utc_offset is None:
+                return "Format error! Please provide your offset from UTC. Format: +hh:mm or -hh:mm"
+            await self.change_zone(user, utc_offset)
+            return "Time zone set to {}.".format(time_zone(utc_offset).name)
         return ""
 
     async def handle_callback(self, callback: telegram.CallbackQuery):
@@ -224,7 +280,7 @@ class PillBot(BotPlugin):
         if user_id != target_user_id:
             return "This is not your timer", True
             pass
-        t = time.time()
+        t = self.now()
         if self.users.get(user_id) is None:
             return "You haven't setup the starting point", True
         self.add_record(user_id, t)
@@ -239,21 +295,20 @@ class PillBot(BotPlugin):
         return "Hack time recorded", False
 
     async def timer_fired(self, record_id, **kwargs):
-        logging.debug("fire time: {}".format(timestamp_to_str(kwargs["event"].time)))
+        debug_time("fire time: %s", kwargs["event"].time)
         r = self.records.get(record_id)
         if r is None:
             return
-        r.timer = None
         if r.description is None:
             description = ""
         else:
             description = r.description
 
-        user = self.get_user(r.user_id)
+        user = await self.get_user(r.user_id)
 
         msg = "Hi {}, yet another day! {}".format(user.name, description)
 
         try:
-            await self.bot.send_message(r.chat_id, msg)
+            await self.outbox.send_message(r.chat_id, msg)
         except telegram.error.TelegramError:
             return
@@ -1,28 +1,146 @@
+import asyncio
+import gc
 import logging
 import re
-import threading
 from html import escape
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import sched_cond
 from BotPlugin import *
+from journal import Journal
+
+# Timers that expired while the bot was down are still delivered if they
+# are late by at most CATCH_UP_WINDOW seconds, and dropped otherwise.
+CATCH_UP_WINDOW = 6 * HOUR_SECONDS
+# Deliveries later than this are marked as late
+LATE_AFTER = 60
+# Live timers one user may have at once
+MAX_TIMERS_PER_USER = 100
 
 
 class TimerBot(BotPlugin):
     prefix = "timer"
+    commands = frozenset(("del", "status"))
+    scheduler_limit = 100000
+
+    def __init__(self, bot: telegram.Bot, scheduler: sched_cond.scheduler_condition, outbox: Outbox):
+        super().__init__(bot, scheduler, outbox)
+        # user_id -> timer_id -> event; ids are per user and never reused
+        self.events: Dict[int, Dict[int, sched_cond.Event]] = dict()
+        self.next_timer_id: Dict[int, int] = dict()
+        self.journal = Journal("data/timer_journal.log", 2, "qqdq")
+        # The compaction started by forget_timer() or start(), while it runs
+        self._compaction: Optional[asyncio.Future] = None
+        # Whether the journal holds more than the timers recover() rescheduled
+        self._stale = False
+        self.recover()
+
+    def start(self):
+        self.journal.open()
+        if self._stale:
+            # Start from a snapshot of what was actually rescheduled
+            self._compaction = asyncio.ensure_future(self.compact())
+
+    async def stop(self):
+        if self._compaction is not None:
+            await self._compaction
+        await self.compact()
+        self.journal.close()
+
+    async def compact(self):
+        """Snapshot the live timers, writing the snapshot off the event loop."""
+        try:
+            records = list(self.records())
+            self.journal.rotate()
+            await self.run_blocking(self.journal.write_snapshot, records)
+        except Exception:
+            logging.exception("timer: compaction failed")
+        finally:
+            self._compaction = None
+
+    def recover(self):
+        """Reschedule the timers left in the journal by the last run."""
+        # Every object made here lives on; collections while they pile up
+        # would only scan them over and over
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._recover()
+        finally:
+            if collecting:
+                gc.enable()
 
-    def __init__(self, bot: telegram.Bot):
-        super().__init__(bot)
-        self.events: Dict[int, List[sched_cond.Event]] = dict()
-        self.scheduler = sched_cond.scheduler_condition(timefunc=time.time, delayfunc=time.sleep)
-        threading.Thread(target=self.scheduler.run).start()
+    def _recover(self):
+        start = time.perf_counter()
+        now = self.scheduler.timefunc()
+        live = self.journal.load()
+        next_timer_id = self.next_timer_id
+        times = []
+        arguments = []
+        for (user_id, timer_id), (at, delay, description) in live.items():
+            if next_timer_id.get(user_id, 0) <= timer_id:
+                next_timer_id[user_id] = timer_id + 1
+            if now - at <= CATCH_UP_WINDOW:
+                times.append(at)
+                arguments.append((user_id, timer_id, delay, description))
+        limit = self.scheduler.limit
+        if limit is not None and len(times) > limit - self.scheduler.pending:
+            room = max(0, limit - self.scheduler.pending)
+            del times[room:], arguments[room:]
+        # One batch: the scheduler queue is built once instead of pushed to
+        # a million times
+        events = self.scheduler.enterabs_many(times, 3, self.timer_fired, arguments,
+                                              owners=[argument[0] for argument in arguments])
+        timers = self.events
+        for event, (user_id, timer_id, _, _) in zip(events, arguments):
+            u = timers.get(user_id)
+            if u is None:
+                u = timers[user_id] = dict()
+            u[timer_id] = event
+        dropped = len(live) - len(events)
+        logging.info("timer: recovered %d timers in %.3fs, dropped %d", len(events),
+                     time.perf_counter() - start, dropped)
+        self._stale = bool(dropped or self.journal.appended)
 
-    def setup_timer(self, user_id: int, delay: int, description: str = ""):
-        u = self.events[user_id]
-        event = self.scheduler.enter(delay, 3, self.timer_fired, argument=(user_id, delay, description))
-        u.append(event)
+    def records(self):
+        for user_id, u in self.events.items():
+            for event in u.values():
+                _, timer_id, delay, description = event.argument
+                yield (user_id, timer_id), (event.time, delay, description)
 
-    def handle_command(self, user: telegram.User, chat: telegram.Chat, parameters: List[str]):
+    def setup_timer(self, user_id: int, at: float, delay: int, description: str = "",
+                    timer_id: Optional[int] = None):
+        """Schedule a timer at absolute time at, and journal it if it is new."""
+        new = timer_id is None
+        if new:
+            timer_id = self.next_timer_id.get(user_id, 0)
+        event = self.scheduler.enterabs(at, 3, self.timer_fired, argument=(user_id, timer_id, delay, description),
+                                        owner=user_id)
+        if new:
+            self.next_timer_id[user_id] = timer_id + 1
+        self.events.setdefault(user_id, dict())[timer_id] = event
+        if new:
+            self.journal.add((user_id, timer_id), (at, delay, description))
+        return event
+
+    def forget_timer(self, user_id: int, event: sched_cond.Event) -> bool:
+        """Drop a fired or deleted timer; return False if it was already gone.
+
+        A timer deleted with /timer del after it was dispatched still runs
+        timer_fired(), which must then neither journal it twice nor send it.
+
+        """
+        u = self.events.get(user_id)
+        if u is None or u.pop(event.argument[1], None) is None:
+            return False
+        if not u:
+            del self.events[user_id]
+        self.journal.remove((user_id, event.argument[1]))
+        if self._compaction is None and self.journal.due(self.scheduler.pending):
+            self._compaction = asyncio.ensure_future(self.compact())
+        return True
+
+    async def handle_command(self, user: telegram.User, chat: telegram.Chat, parameters: List[str]):
         if len(parameters) == 0:
             return "<code>/timer mm &lt;description&gt;</code>     set a timer after <code>mm</code> minutes\n" \
                    "<code>/timer hh:mm &lt;description&gt;</code>  set a timer after <code>hh</code> hours and <code>mm</code> minutes\n" \
@@ -31,30 +149,29 @@ class TimerBot(BotPlugin):
         if parameters[0] == "del":
             if len(parameters) != 2:
                 return "Please provide timer's id"
-            if self.events.get(user.id) is None:
+            u = self.events.get(user.id)
+            if u is None:
                 return "You haven't set any timer."
-            u = self.events[user.id]
             try:
                 timer_id = int(parameters[1])
             except ValueError:
                 timer_id = -1
-            if len(u) < timer_id or timer_id < 0:
+            event = u.get(timer_id)
+            if event is None:
                 return "Timer not found"
-            event = u[timer_id]
             self.scheduler.cancel(event)
-            u.remove(event)
+            self.forget_timer(user.id, event)
             return "Removed"
 
         if parameters[0] == "status":
-            if self.events.get(user.id) is None:
-                return "You haven't set any timer."
-            u = self.events[user.id]
-            if len(u) == 0:
+            u = self.events.get(user.id)
+            if not u:
                 return "You haven't set any timer."
             reply = "Current timers:\n"
-            for i, x in enumerate(u):
-                if x.argument[2] != "":
-                    des = x.argument[2]
+            for x in self.scheduler.events_for(user.id):
+                i = x.argument[1]
+                if x.argument[3] != "":
+                    des = x.argument[3]
                 else:
                     des = "(no description)"
                 reply += "{:04}  at {} {}\n".format(i, day_time_to_str(int(x.time)), des)
@@ -87,26 +204,29 @@ class TimerBot(BotPlugin):
         else:
             des = ""
 
-        if self.events.get(user.id) is None:
-            self.events[user.id] = []
-        u = self.events[user.id]
-        if DEBUG:
-            event = self.scheduler.enter(delay, 3, self.timer_fired, (user.id, delay, des))
-        else:
-            event = self.scheduler.enter(delay * 60, 3, self.timer_fired, (user.id, delay * 60, des))
-        u.append(event)
+        if len(self.events.get(user.id, ())) >= MAX_TIMERS_PER_USER:
+            return "You can't have more than {} timers running".format(MAX_TIMERS_PER_USER)
+        if not DEBUG:
+            delay *= 60
+        try:
+            self.setup_timer(user.id, self.scheduler.timefunc() + delay, delay, des)
+        except sched_cond.SchedulerFull:
+            return "Too many timers are running, please try again later"
         return "Timer set"
 
-    async def timer_fired(self, user_id, delay: int, description: str, **kwargs):
-        logging.debug("fire time: {}".format(timestamp_to_str(kwargs["event"].time)))
-        u = self.events[user_id]
-        u.remove(kwargs["event"])
+    async def timer_fired(self, user_id, timer_id: int, delay: int, description: str, **kwargs):
+        event = kwargs["event"]
+        debug_time("fire time: %s", event.time)
+        if not self.forget_timer(user_id, event):
+            return
         if description != "":
             msg = "Time's up! Timer description:\n"+escape(description, quote=False)
         else:
             msg = "Time's up! {} elapsed.".format(time_interval_to_remain(delay))
+        if self.scheduler.timefunc() - event.time > LATE_AFTER:
+            msg += "\n(Delivered late, this timer was due at {})".format(timestamp_to_str(event.time))
         try:
-            await self.bot.send_message(user_id, msg)
+            await self.outbox.send_message(user_id, msg)
         except telegram.error.TelegramError as e:
             print(e)
             return
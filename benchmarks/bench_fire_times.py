@@ -0,0 +1,95 @@
+"""Bulk next-fire-time computation, with and without NumPy.
+
+    python benchmarks/bench_fire_times.py [chains ...]
+
+fire_times.next_fire_times() over chains with random start times and
+one of a few dozen settings, through the plain loop and, if NumPy is
+installed, the array path.  Then arming the timers of as many HackBot
+cohorts (a custom setting per user puts each user in a cohort of its
+own) on an empty scheduler: one cohort at a time as before, and all of
+them through HackBot.start_cohorts(), which enters every new_day event
+and reminder in two batches.
+"""
+import random
+import sqlite3
+import sys
+import time
+
+import fixtures
+
+import fire_times  # noqa: E402
+import sched_cond  # noqa: E402
+from HackBot import HackBot  # noqa: E402
+
+SIZES = [1000, 10000, 100000]
+NOW = 1700000000.5
+
+
+def random_setting(rng):
+    return tuple(sorted(rng.sample(range(60, 86400, 60), rng.randrange(1, 10)), reverse=True))
+
+
+def bench_compute(size, rng):
+    settings = [random_setting(rng) for _ in range(40)]
+    start_times = [rng.randrange(1440) * 60 for _ in range(size)]
+    chains = [rng.choice(settings) for _ in range(size)]
+    row = []
+    for function in (fire_times._next_fire_times_py, fire_times._next_fire_times_numpy):
+        if function is fire_times._next_fire_times_numpy and not fire_times.HAVE_NUMPY:
+            row.append(None)
+            continue
+        start = time.perf_counter()
+        function(start_times, chains, NOW)
+        row.append(time.perf_counter() - start)
+    return row
+
+
+def load_hack_bot(size, rng):
+    fixtures.make_data_dir()
+    db = sqlite3.connect("data/hack_data.sqlite")
+    db.executemany("INSERT INTO user VALUES (?,?,?,?,?,?,?)",
+                   ((i, "user%d" % i, "First", "Last", "en", rng.randrange(1440) * 60,
+                     " ".join(map(str, random_setting(rng)))) for i in range(1, size + 1)))
+    db.commit()
+    db.close()
+    return HackBot(fixtures.FakeBot(), sched_cond.scheduler_condition(timefunc=lambda: NOW), None)
+
+
+def bench_arm(hack, bulk, use_numpy):
+    hack.scheduler = sched_cond.scheduler_condition(timefunc=lambda: NOW)
+    hack.deferred = []
+    cohorts = list(hack.cohorts.values())
+    have_numpy = fire_times.HAVE_NUMPY
+    fire_times.HAVE_NUMPY = have_numpy and use_numpy
+    try:
+        start = time.perf_counter()
+        if bulk:
+            hack.start_cohorts(cohorts)
+        else:
+            for cohort in cohorts:
+                hack.start_cohort(cohort)
+        return time.perf_counter() - start
+    finally:
+        fire_times.HAVE_NUMPY = have_numpy
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or SIZES
+    rng = random.Random(0)
+    print("NumPy: {}".format("yes" if fire_times.HAVE_NUMPY else "not installed"))
+    print("{:>9}  {:>12} {:>12}".format("chains", "loop", "numpy"))
+    for size in sizes:
+        loop, array = bench_compute(size, rng)
+        print("{:>9}  {:>11.2f}ms {:>12}".format(
+            size, loop * 1e3, "-" if array is None else "{:.2f}ms".format(array * 1e3)))
+    print()
+    print("{:>9}  {:>12} {:>12} {:>12}".format("cohorts", "one by one", "bulk loop", "bulk numpy"))
+    for size in sizes:
+        hack = load_hack_bot(size, rng)
+        print("{:>9}  {:>11.3f}s {:>11.3f}s {:>11.3f}s".format(
+            len(hack.cohorts), bench_arm(hack, False, False), bench_arm(hack, True, False),
+            bench_arm(hack, True, True)))
+
+
+if __name__ == "__main__":
+    main()
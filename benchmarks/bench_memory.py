@@ -0,0 +1,58 @@
+"""Memory held per user by HackBot and PillBot.
+
+    python benchmarks/bench_memory.py [users]
+
+Loads users (HackBot: half on the default timer setting, half on one
+of a few custom ones, each with a pending message to delete) and one
+pill record per user, and reports the Python heap grown by each plugin,
+in bytes per user, as measured by tracemalloc.  The scheduler events
+of the plugins are included.
+"""
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+import fixtures
+
+import sched_cond  # noqa: E402
+from HackBot import HackBot  # noqa: E402
+from PillBot import PillBot  # noqa: E402
+
+USERS = 100000
+SETTINGS = ["3600 1800 600", "7200 600", "43200 3600 300 60"]
+
+
+def measure(factory):
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    plugin = factory()
+    gc.collect()
+    return plugin, tracemalloc.get_traced_memory()[0] - before
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    fixtures.make_data_dir()
+    fixtures.populate(users, random.Random(0), SETTINGS)
+
+    tracemalloc.start()
+    scheduler = sched_cond.scheduler_condition(timefunc=time.time)
+
+    def hack_bot():
+        bot = HackBot(fixtures.FakeBot(), scheduler, None)
+        # One reminder waiting to be deleted, as after any reminder
+        for u in bot.users.values():
+            bot.remember_message(u, (u.user_id, 1))
+        return bot
+
+    hack, hack_bytes = measure(hack_bot)
+    pill, pill_bytes = measure(lambda: PillBot(fixtures.FakeBot(), scheduler, None))
+    print("{} users".format(users))
+    print("  HackBot  {:>8.0f} bytes/user".format(hack_bytes / users))
+    print("  PillBot  {:>8.0f} bytes/user (record, cached user and timer)".format(pill_bytes / users))
+
+
+if __name__ == "__main__":
+    main()
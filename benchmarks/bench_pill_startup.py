@@ -0,0 +1,45 @@
+"""Cold start of PillBot with many records.
+
+    python benchmarks/bench_pill_startup.py [records] [users]
+"""
+import random
+import sqlite3
+import sys
+import time
+
+import fixtures
+
+import sched_cond  # noqa: E402
+from PillBot import PillBot  # noqa: E402
+
+RECORDS = 100000
+USERS = 20000
+
+
+def populate(records, users, rng):
+    db = sqlite3.connect("data/pill_data.sqlite")
+    db.executemany("INSERT INTO user VALUES (?,?,?,?,?)",
+                   ((i, "user%d" % i, "First", "Last", "en") for i in range(1, users + 1)))
+    db.executemany("INSERT INTO pill_record(user_id, chat_id, alarm_time, description) VALUES (?,?,?,?)",
+                   ((u, u, rng.randrange(1440) * 60, "pill") for u in
+                    (rng.randrange(1, users + 1) for _ in range(records))))
+    db.commit()
+    db.close()
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else RECORDS
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else USERS
+    fixtures.make_data_dir()
+    populate(records, users, random.Random(0))
+
+    scheduler = sched_cond.scheduler_condition(timefunc=time.time)
+    start = time.perf_counter()
+    bot = PillBot(fixtures.FakeBot(), scheduler, None)
+    elapsed = time.perf_counter() - start
+    print("{} records, {} users: startup {:.3f}s, {} users cached, {} events".format(
+        len(bot.records), users, elapsed, len(bot.users), len(scheduler)))
+
+
+if __name__ == "__main__":
+    main()
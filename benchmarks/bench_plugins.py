@@ -0,0 +1,87 @@
+"""Timer paths of the plugins on a virtual clock.
+
+    python benchmarks/bench_plugins.py [users]
+
+Every plugin runs against a FakeBot and a scheduler whose clock only
+moves from one due event to the next, so a simulated day takes as long
+as the work done in it:
+
+- HackBot: startup (cohorts and their timers), then one day of
+  new_day greetings and timer_fired reminders,
+- PillBot: one day of alarms, one record per user,
+- TimerBot: setting one timer per user through /timer, then firing
+  them all.
+"""
+import asyncio
+import random
+import sys
+import time
+import types
+
+import fixtures
+
+import sched_cond  # noqa: E402
+from BotPlugin import DAY_SECONDS  # noqa: E402
+from HackBot import HackBot  # noqa: E402
+from outbox import Outbox  # noqa: E402
+from PillBot import PillBot  # noqa: E402
+from TimerBot import TimerBot  # noqa: E402
+
+USERS = 10000
+START = 1700000000
+
+
+def report(name, elapsed, count, unit):
+    print("{:<28} {:>9.3f}s  {:>9} {:<10} {:>9.2f} us each".format(
+        name, elapsed, count, unit, elapsed / count * 1e6 if count else 0))
+
+
+async def run_day(plugin, scheduler, clock, outbox, bot, name):
+    calls = len(bot.calls)
+    start = time.perf_counter()
+    dispatched = await fixtures.drive(scheduler, clock, clock.now + DAY_SECONDS, outbox)
+    elapsed = time.perf_counter() - start
+    report(name + " day", elapsed, len(bot.calls) - calls, "calls")
+    return dispatched
+
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    fixtures.make_data_dir()
+    fixtures.populate(users, random.Random(0))
+
+    bot = fixtures.FakeBot()
+    clock = fixtures.VirtualClock(START)
+    outbox = Outbox(bot, rate=None, chat_interval=0, timefunc=clock)
+    outbox.start()
+
+    scheduler = sched_cond.scheduler_condition(timefunc=clock)
+    start = time.perf_counter()
+    hack = HackBot(bot, scheduler, outbox)
+    report("HackBot startup", time.perf_counter() - start, len(hack.users), "users")
+    await run_day(hack, scheduler, clock, outbox, bot, "HackBot")
+    await hack.stop()
+
+    scheduler = sched_cond.scheduler_condition(timefunc=clock)
+    start = time.perf_counter()
+    pill = PillBot(bot, scheduler, outbox)
+    report("PillBot startup", time.perf_counter() - start, len(pill.records), "records")
+    await run_day(pill, scheduler, clock, outbox, bot, "PillBot")
+    await pill.stop()
+
+    scheduler = sched_cond.scheduler_condition(timefunc=clock)
+    timer = TimerBot(bot, scheduler, outbox)
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for i in range(1, users + 1):
+        user = types.SimpleNamespace(id=i)
+        await timer.handle_command(user, user, [str(rng.randrange(1, 1440)), "timer"])
+    report("TimerBot /timer", time.perf_counter() - start, users, "timers")
+    await run_day(timer, scheduler, clock, outbox, bot, "TimerBot")
+    await timer.stop()
+
+    await outbox.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
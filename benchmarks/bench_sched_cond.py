@@ -0,0 +1,130 @@
+"""Micro benchmarks for sched_cond.
+
+Run from the repository root:
+
+    python benchmarks/bench_sched_cond.py
+
+Cancel cost should stay flat while the queue grows.  The scheduler
+table measures the public API at several queue sizes: enterabs(), a
+snapshot of .queue and dispatching every event through
+run(blocking=False) on a virtual clock.  The backend
+comparison fills each queue backend with events on minute boundaries
+within the next 36 hours, cancels a tenth of them and drains the rest
+minute by minute, like the reminders of HackBot and PillBot.
+
+    python benchmarks/bench_sched_cond.py 10000 100000 1000000
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sched_cond  # noqa: E402
+from fixtures import VirtualClock  # noqa: E402
+
+SIZES = [1000, 10000, 100000]
+CANCELS = 1000
+BACKEND_SIZES = [10000, 100000, 1000000]
+MINUTE = 60
+HORIZON = 36 * 60 * MINUTE
+
+
+async def _noop(*args, **kwargs):
+    pass
+
+
+def bench_cancel(size, rng):
+    scheduler = sched_cond.scheduler_condition(timefunc=lambda: 0)
+    events = [scheduler.enterabs(rng.randrange(86400), 3, _noop) for _ in range(size)]
+    victims = rng.sample(events, CANCELS)
+    start = time.perf_counter()
+    for event in victims:
+        scheduler.cancel(event)
+    elapsed = time.perf_counter() - start
+    assert len(scheduler) == size - CANCELS
+    return elapsed / CANCELS
+
+
+def bench_scheduler(size, rng):
+    clock = VirtualClock(0)
+    scheduler = sched_cond.scheduler_condition(timefunc=clock, max_concurrency=size)
+    times = [rng.randrange(1, 86400) for _ in range(size)]
+
+    start = time.perf_counter()
+    for t in times:
+        scheduler.enterabs(t, 3, _noop)
+    enqueue = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert len(scheduler.queue) == size
+    snapshot = time.perf_counter() - start
+
+    async def dispatch():
+        clock.now = 86400
+        start = time.perf_counter()
+        await scheduler.run(blocking=False)
+        await scheduler.join()
+        return time.perf_counter() - start
+
+    dispatch = asyncio.run(dispatch())
+    assert scheduler.empty()
+    return enqueue / size, snapshot, dispatch / size
+
+
+def bench_backend(backend, size, rng):
+    now = 0
+    queue = sched_cond.BACKENDS[backend](now)
+    times = [rng.randrange(1, HORIZON // MINUTE) * MINUTE for _ in range(size)]
+    events = [sched_cond.Event(t, 3, _noop, (), None) for t in times]
+
+    start = time.perf_counter()
+    for event in events:
+        queue.push(event)
+    insert = time.perf_counter() - start
+
+    victims = events[::10]
+    start = time.perf_counter()
+    for event in victims:
+        event.cancelled = True
+        queue.cancel(event)
+    cancel = time.perf_counter() - start
+
+    popped = 0
+    start = time.perf_counter()
+    while now <= HORIZON:
+        while queue.peek(now) is not None:
+            queue.pop()
+            popped += 1
+        now += MINUTE
+    drain = time.perf_counter() - start
+    assert popped == size - len(victims)
+    return insert / size, cancel / len(victims), drain / popped
+
+
+def main():
+    rng = random.Random(0)
+    print("{:>10}  {:>14}".format("queue", "cancel (us)"))
+    for size in SIZES:
+        print("{:>10}  {:>14.3f}".format(size, bench_cancel(size, rng) * 1e6))
+
+    print()
+    print("{:>10}  {:>14}  {:>14}  {:>14}".format("queue", "enqueue (us)", "snapshot (ms)", "dispatch (us)"))
+    for size in SIZES:
+        enqueue, snapshot, dispatch = bench_scheduler(size, rng)
+        print("{:>10}  {:>14.3f}  {:>14.3f}  {:>14.3f}".format(size, enqueue * 1e6, snapshot * 1e3, dispatch * 1e6))
+
+    sizes = [int(x) for x in sys.argv[1:]] or BACKEND_SIZES
+    print()
+    print("{:>8}  {:>10}  {:>12}  {:>12}  {:>12}".format("backend", "events", "insert (us)", "cancel (us)", "pop (us)"))
+    for size in sizes:
+        for backend in sched_cond.BACKENDS:
+            insert, cancel, pop = bench_backend(backend, size, random.Random(size))
+            print("{:>8}  {:>10}  {:>12.3f}  {:>12.3f}  {:>12.3f}".format(
+                backend, size, insert * 1e6, cancel * 1e6, pop * 1e6))
+
+
+if __name__ == "__main__":
+    main()
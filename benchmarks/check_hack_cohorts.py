@@ -0,0 +1,127 @@
+"""Checks of the HackBot cohorts.
+
+    python benchmarks/check_hack_cohorts.py
+
+Users join and leave cohorts through /hack commands on a virtual clock;
+fails with an AssertionError if a cohort keeps events nobody needs or
+an event of a dropped cohort breaks when it runs.
+"""
+import asyncio
+import types
+
+import fixtures
+
+import sched_cond  # noqa: E402
+from HackBot import HackBot  # noqa: E402
+from outbox import Outbox  # noqa: E402
+
+START = 1700000000
+
+
+def user(user_id):
+    return types.SimpleNamespace(id=user_id, username="user%d" % user_id, first_name="First", last_name="Last",
+                                 language_code="en")
+
+
+async def command(hack, user_id, *parameters):
+    return await hack.handle_command(user(user_id), None, list(parameters))
+
+
+def pending_events(hack):
+    return hack.scheduler.scheduler._queue.events()
+
+
+def cohort_events(hack, cohort):
+    """Pending events of the cohort: its new_day event and reminder chain."""
+    return [event for event in pending_events(hack) if event.argument[:1] == (cohort.key,)]
+
+
+async def make_hack():
+    fixtures.make_data_dir()
+    clock = fixtures.VirtualClock(START)
+    scheduler = sched_cond.scheduler_condition(timefunc=clock)
+    outbox = Outbox(fixtures.FakeBot(), rate=None, chat_interval=0, timefunc=clock)
+    outbox.start()
+    return HackBot(outbox.bot, scheduler, outbox), clock
+
+
+async def check_join_and_leave():
+    hack, _ = await make_hack()
+    # The clock starts at 06:13 UTC+8, so the next reminder of the 7:00
+    # cohort is within HackBot.HORIZON and armed
+    assert await command(hack, 1, "start", "7:00") == "Set"
+    assert await command(hack, 2, "start", "7:00") == "Set"
+    assert await command(hack, 3, "start", "9:00") == "Set"
+    assert len(hack.cohorts) == 2
+    cohort = hack.cohorts[hack.users[1].cohort_key]
+    assert cohort.members == {1, 2}
+    assert len(cohort_events(hack, cohort)) == 2
+
+    await command(hack, 1, "stop")
+    assert cohort.members == {2} and len(cohort_events(hack, cohort)) == 2
+    # Moving the last member away drops the cohort and its events
+    assert await command(hack, 2, "start", "9:00") == "Changed"
+    assert len(hack.cohorts) == 1 and hack.cohorts[hack.users[3].cohort_key].members == {2, 3}
+    assert not cohort_events(hack, cohort)
+    await command(hack, 2, "stop")
+    await command(hack, 3, "stop")
+    assert not hack.cohorts
+    assert [event.action.__name__ for event in pending_events(hack)] == ["refill"]
+    await hack.outbox.stop()
+
+
+async def fire_after_leaving(hack, clock, user_id, rejoin):
+    cohort = hack.cohorts[hack.users[user_id].cohort_key]
+    clock.now = cohort.timer.time
+    # Dispatches the reminder; its task only runs at the next await
+    await hack.scheduler.scheduler.run(blocking=False)
+    await command(hack, user_id, "stop")
+    if rejoin:
+        await command(hack, user_id, "start", "7:00")
+    await hack.scheduler.scheduler.join()
+    assert hack.scheduler.failed == 0, hack.scheduler.stats()
+
+
+async def check_events_of_dropped_cohorts():
+    hack, clock = await make_hack()
+    await command(hack, 1, "start", "7:00")
+    await fire_after_leaving(hack, clock, 1, rejoin=False)
+    assert not hack.cohorts
+
+    # A new cohort under the same key keeps a single reminder chain
+    await command(hack, 1, "start", "7:00")
+    await fire_after_leaving(hack, clock, 1, rejoin=True)
+    cohort = hack.cohorts[hack.users[1].cohort_key]
+    events = cohort_events(hack, cohort)
+    assert sorted(event.action.__name__ for event in events) == ["new_day", "timer_fired"], events
+    assert cohort.timer in events
+    await hack.outbox.stop()
+
+
+async def check_users_without_timers():
+    """A user with only a time zone, or stopped, has no timers until /hack start."""
+    hack, _ = await make_hack()
+    assert (await command(hack, 1, "zone", "+2")).endswith("/hack start hh:mm.")
+    assert await command(hack, 1, "status") == "No timer is set"
+    assert not hack.cohorts
+    assert await command(hack, 1, "start", "7:00") == "Set"
+    assert hack.users[1].start_time == 5 * 3600
+    assert await command(hack, 1, "start", "6:00") == "Changed"
+    # 08:00 UTC+8 is a start time of 0 seconds
+    assert await command(hack, 2, "start", "8:00") == "Set" and hack.users[2].start_time == 0
+    for user_id in (1, 2):
+        assert await command(hack, user_id, "stop") == "Timers removed."
+        assert await command(hack, user_id, "status") == "No timer is set"
+    assert not hack.cohorts
+    assert await command(hack, 2, "start", "8:00") == "Set"
+    await hack.outbox.stop()
+
+
+async def main():
+    for check in (check_join_and_leave, check_events_of_dropped_cohorts, check_users_without_timers):
+        await check()
+        print("ok", check.__name__)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""Checks of the TimerBot journal.
+
+    python benchmarks/check_journal.py
+
+Fails with an AssertionError if a journal does not replay to the live
+set it was written with.
+"""
+import os
+
+import fixtures
+
+from journal import Journal  # noqa: E402
+
+
+def open_journal():
+    fixtures.make_data_dir()
+    return Journal("data/journal.log", 2, "qqdq")
+
+
+def check_torn_line():
+    """A torn last line is dropped and lines appended later still load."""
+    journal = open_journal()
+    journal.add((1, 0), (4.5, 60, "first"))
+    journal.close()
+    with open(journal.path, "a") as f:
+        f.write("A\t1\t1\t4.5")  # crash in the middle of a line
+    assert journal.load() == {(1, 0): (4.5, 60, "first")}
+    journal.add((1, 2), (5.5, 60, "after the crash"))
+    journal.close()
+    assert journal.load() == {(1, 0): (4.5, 60, "first"), (1, 2): (5.5, 60, "after the crash")}
+    assert journal.appended == 2
+
+
+def check_bad_lines():
+    """Complete lines that do not parse are skipped, not raised."""
+    journal = open_journal()
+    journal.add((1, 0), (4.5, 60, "kept"))
+    journal.close()
+    with open(journal.path, "ab") as f:
+        f.write(b"A\t1\t1\t4.5A\t60\tmerged\n")
+        f.write(b"X\t1\t0\n")
+        f.write(b"A\t1\t2\t5.5\t60\t\xff\n")
+        f.write(b"D\t1\n")
+    assert journal.load() == {(1, 0): (4.5, 60, "kept")}
+    assert journal.appended == 5
+
+
+def check_interrupted_compaction():
+    """Lines of a rotated journal whose snapshot was never written survive."""
+    journal = open_journal()
+    journal.add((1, 0), (4.5, 60, "before"))
+    journal.add((1, 1), (5.5, 60, "removed"))
+    journal.rotate()
+    journal.remove((1, 1))
+    journal.add((2, 0), (6.5, 60, "after\ttab"))
+    journal.close()
+    expected = {(1, 0): (4.5, 60, "before"), (2, 0): (6.5, 60, "after\ttab")}
+    assert journal.load() == expected
+    journal.compact(expected.items())
+    assert not os.path.exists(journal.rotated_path)
+    assert not os.path.exists(journal.path) or os.path.getsize(journal.path) == 0
+    assert journal.load() == expected and journal.replayed == 0
+
+
+def main():
+    for check in (check_torn_line, check_bad_lines, check_interrupted_compaction):
+        check()
+        print("ok", check.__name__)
+
+
+if __name__ == "__main__":
+    main()
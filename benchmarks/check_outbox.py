@@ -0,0 +1,68 @@
+"""Checks of the Outbox against a FakeBot.
+
+    python benchmarks/check_outbox.py
+
+Runs every Bot method the plugins use through an Outbox and fails with
+an AssertionError if a call does not reach the bot as made.
+"""
+import asyncio
+import time
+
+import fixtures
+
+from outbox import BULK, INTERACTIVE, Outbox  # noqa: E402
+
+
+async def check_methods():
+    bot = fixtures.FakeBot()
+    outbox = Outbox(bot, rate=None, chat_interval=0)
+    outbox.start()
+    message = await outbox.send_message(1, "hello")
+    assert await outbox.edit_message_text("edited", chat_id=message.chat_id, message_id=message.message_id)
+    assert await outbox.delete_message(message.chat_id, message.message_id)
+    await outbox.stop()
+    assert bot.calls == [("send_message", 1, "hello"), ("edit_message_text", 1, "edited"),
+                         ("delete_message", 1, message.message_id)], bot.calls
+
+
+async def check_interactive_overtakes_full_queue():
+    bot = fixtures.FakeBot()
+    outbox = Outbox(bot, rate=None, chat_interval=0, maxsize=10, max_concurrency=1)
+    bulk = [asyncio.ensure_future(outbox.send_message(i, "bulk", priority=BULK)) for i in range(100)]
+    await asyncio.sleep(0)
+    assert outbox.depth == 10, outbox.depth
+    reply = asyncio.ensure_future(outbox.send_message(1000, "reply", priority=INTERACTIVE))
+    await asyncio.sleep(0)
+    outbox.start()
+    await reply
+    await asyncio.gather(*bulk)
+    await outbox.stop()
+    sent = [call[1] for call in bot.calls]
+    assert sent.index(1000) == 0, sent[:5]
+
+
+async def check_group_interval():
+    """Groups (negative ids) get group_interval between messages, users chat_interval."""
+    outbox = Outbox(fixtures.FakeBot(), rate=None, chat_interval=0.01, group_interval=0.1)
+    outbox.start()
+
+    async def send(chat_id):
+        await outbox.send_message(chat_id, "hello")
+        return time.monotonic()
+
+    start = time.monotonic()
+    user = await asyncio.gather(*[send(1) for _ in range(3)])
+    group = await asyncio.gather(*[send(-1) for _ in range(3)])
+    await outbox.stop()
+    assert user[-1] - start < 0.1, user
+    assert group[-1] - group[0] >= 0.19, group
+
+
+async def main():
+    for check in (check_methods, check_interactive_overtakes_full_queue, check_group_interval):
+        await check()
+        print("ok", check.__name__)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""Checks of WriteBehindDB.
+
+    python benchmarks/check_persistence.py
+
+Fails with an AssertionError if a statement queued before close() is
+not in the database afterwards.
+"""
+import asyncio
+import sqlite3
+
+import fixtures
+
+from persistence import WriteBehindDB  # noqa: E402
+
+STATEMENTS = 1000
+
+
+def open_db():
+    fixtures.make_data_dir()
+    db = WriteBehindDB("data/check.sqlite", batch_size=16)
+    db.reader.execute("CREATE TABLE t (x INTEGER)")
+    db.reader.commit()
+    for x in range(STATEMENTS):
+        db.execute("INSERT INTO t VALUES (?)", (x,))
+    return db
+
+
+def count():
+    db = sqlite3.connect("data/check.sqlite")
+    try:
+        return db.execute("SELECT count(*), sum(x) FROM t").fetchone()
+    finally:
+        db.close()
+
+
+async def check_close_without_writer():
+    """close() applies every batch when start() was never called."""
+    db = open_db()
+    await db.close()
+    assert count() == (STATEMENTS, STATEMENTS * (STATEMENTS - 1) // 2), count()
+
+
+async def check_close_with_writer():
+    db = open_db()
+    db.start()
+    await asyncio.sleep(0)
+    db.execute("INSERT INTO t VALUES (?)", (-1,))
+    await db.close()
+    assert count()[0] == STATEMENTS + 1, count()
+    assert db.depth == 0
+
+
+async def check_flush():
+    """After flush() the reader sees every queued statement."""
+    db = open_db()
+    db.start()
+    await db.flush()
+    assert db.query("SELECT count(*) FROM t").fetchone()[0] == STATEMENTS
+    assert db.batches >= STATEMENTS // 16 and db.committed == STATEMENTS
+    await db.close()
+
+
+async def main():
+    for check in (check_close_without_writer, check_close_with_writer, check_flush):
+        await check()
+        print("ok", check.__name__)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
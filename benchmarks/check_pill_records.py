@@ -0,0 +1,96 @@
+"""Checks of the PillBot record indexes.
+
+    python benchmarks/check_pill_records.py
+
+Adds, lists and deletes records through /pill commands and fails with an
+AssertionError if the per-user and per-chat indexes disagree with the
+records, before or after a restart.
+"""
+import asyncio
+import types
+
+import fixtures
+
+import PillBot  # noqa: E402
+import sched_cond  # noqa: E402
+from outbox import Outbox  # noqa: E402
+
+START = 1700000000
+GROUP = -100
+
+
+def user(user_id):
+    return types.SimpleNamespace(id=user_id, username="user%d" % user_id, first_name="First", last_name="Last",
+                                 language_code="en")
+
+
+async def command(pill, user_id, chat_id, *parameters):
+    return await pill.handle_command(user(user_id), types.SimpleNamespace(id=chat_id), list(parameters))
+
+
+def make_pill(bot):
+    clock = fixtures.VirtualClock(START)
+    pill = PillBot.PillBot(bot, sched_cond.scheduler_condition(timefunc=clock), Outbox(bot, timefunc=clock))
+    pill.start()
+    return pill
+
+
+def expected_indexes(pill):
+    by_user = {}
+    by_user_chat = {}
+    for record_id in sorted(pill.records):
+        r = pill.records[record_id]
+        by_user[r.user_id] = by_user.get(r.user_id, ()) + (record_id,)
+        key = (r.user_id, r.chat_id)
+        by_user_chat[key] = by_user_chat.get(key, ()) + (record_id,)
+    return by_user, by_user_chat
+
+
+def check_indexes(pill):
+    assert (pill.by_user, pill.by_user_chat) == expected_indexes(pill), (pill.by_user, pill.by_user_chat)
+
+
+async def check_records():
+    fixtures.make_data_dir()
+    # Outside DEBUG the bot loads the records of every user
+    PillBot.DEBUG = False
+    bot = fixtures.FakeBot()
+    pill = make_pill(bot)
+    assert await command(pill, 1, 1, "add", "8:00", "private") == "Added"
+    assert await command(pill, 1, GROUP, "add", "9:00", "group") == "Added"
+    assert await command(pill, 2, GROUP, "add", "9:00", "other user") == "Added"
+    assert await command(pill, 1, GROUP, "add", "10:00", "group again") == "Added"
+    check_indexes(pill)
+    assert pill.by_user[1] == (1, 2, 4) and pill.by_user_chat[(1, GROUP)] == (2, 4)
+
+    # In private all of a user's records are listed, in a group only its own
+    assert len((await command(pill, 1, 1, "list")).splitlines()) == 1 + 3
+    listed = await command(pill, 1, GROUP, "list")
+    assert "group again" in listed and "private" not in listed and "other user" not in listed
+
+    assert await command(pill, 1, GROUP, "del", "3") == "This is not your timer"
+    assert await command(pill, 1, 1, "del", "2") == "Removed!"
+    assert await command(pill, 1, 1, "del", "2") == "You haven't set up the timer."
+    check_indexes(pill)
+    assert pill.by_user_chat[(1, GROUP)] == (4,)
+    assert await command(pill, 2, GROUP, "del", "3") == "Removed!"
+    assert 2 not in pill.by_user and (2, GROUP) not in pill.by_user_chat
+    await pill.stop()
+
+    # A restart rebuilds the same indexes from the database
+    restarted = make_pill(bot)
+    check_indexes(restarted)
+    assert restarted.by_user == pill.by_user and restarted.by_user_chat == pill.by_user_chat
+    assert await command(restarted, 1, 1, "add", "11:00") == "Added"
+    assert restarted.by_user[1] == (1, 4, 5)
+    await restarted.stop()
+
+
+async def main():
+    for check in (check_records,):
+        await check()
+        print("ok", check.__name__)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
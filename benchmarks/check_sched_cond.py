@@ -0,0 +1,82 @@
+"""Checks of sched_cond.
+
+    python benchmarks/check_sched_cond.py
+
+Fails with an AssertionError if the scheduler misbehaves.
+"""
+import asyncio
+import random
+
+import fixtures  # noqa: F401  (puts the repository on sys.path)
+
+import sched_cond  # noqa: E402
+
+
+async def check_unstartable_actions():
+    """An action that cannot be started fails its event, not run()."""
+    scheduler = sched_cond.scheduler_condition(timefunc=lambda: 0)
+    ns = scheduler.namespace("check")
+    done = []
+
+    async def one_argument(x, **kwargs):
+        pass
+
+    def not_async(**kwargs):
+        return 1
+
+    async def good(**kwargs):
+        done.append(True)
+
+    ns.enterabs(0, 1, one_argument, argument=(1, 2))
+    ns.enterabs(0, 1, not_async)
+    ns.enterabs(0, 1, good)
+    assert await scheduler.run(blocking=False) is None
+    await scheduler.join()
+    assert done == [True]
+    assert ns.failed == 2 and ns.dispatched == 3, ns.stats()
+    assert scheduler._slots._value == scheduler.max_concurrency
+
+
+def drain(queue, now, step):
+    order = []
+    while len(queue):
+        event = queue.peek(now)
+        if event is None:
+            now += step
+            continue
+        queue.pop()
+        order.append(event.argument)
+    return order
+
+
+async def check_backends_agree():
+    """The timing wheel dispatches events in the order of the heap."""
+    rng = random.Random(0)
+    now = 1700000000.0
+    # Seconds to months ahead, so that events cascade down every level
+    times = [now + rng.choice((rng.random() * 120, rng.randrange(86400), rng.randrange(90 * 86400)))
+             for _ in range(20000)]
+    times += times[:1000]  # equal times are ordered by priority, then entry
+    orders = []
+    for backend in ("heap", "wheel"):
+        queue = sched_cond.BACKENDS[backend](now)
+        events = [sched_cond.Event(t, i % 3, None, (i,), None) for i, t in enumerate(times)]
+        queue.extend(events[:10000])
+        for event in events[10000:]:
+            queue.push(event)
+        for event in events[::7]:
+            event.cancelled = True
+            queue.cancel(event)
+        orders.append(drain(queue, now, 3600))
+    assert len(orders[0]) == len(times) - len(times[::7])
+    assert orders[0] == orders[1]
+
+
+async def main():
+    for check in (check_unstartable_actions, check_backends_agree):
+        await check()
+        print("ok", check.__name__)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+"""Shared helpers for the benchmark scripts: database schemas and
+users to fill them with, a fake telegram.Bot that records calls instead
+of sending them and a virtual clock to run the scheduler on."""
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+HACK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, language_code TEXT,
+    start_time INTEGER, time_setting TEXT
+);
+CREATE TABLE IF NOT EXISTS hack_record (user_id INTEGER, time REAL);
+CREATE INDEX IF NOT EXISTS hack_record_user ON hack_record (user_id, time);
+CREATE VIEW IF NOT EXISTS latest_hack AS
+    SELECT user_id, max(time) AS latest_hack_time FROM hack_record GROUP BY user_id;
+"""
+
+PILL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, language_code TEXT
+);
+CREATE TABLE IF NOT EXISTS pill_record (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, chat_id INTEGER, alarm_time INTEGER, description TEXT
+);
+"""
+
+
+def make_data_dir():
+    """chdir into a fresh directory holding empty data/*.sqlite files.
+
+    The plugins open their databases relative to the working directory.
+    """
+    root = tempfile.mkdtemp(prefix="notificationbot-")
+    os.chdir(root)
+    os.mkdir("data")
+    for name, schema in (("hack_data", HACK_SCHEMA), ("pill_data", PILL_SCHEMA)):
+        db = sqlite3.connect(os.path.join("data", name + ".sqlite"))
+        db.executescript(schema)
+        db.commit()
+        db.close()
+    return root
+
+
+def populate(users, rng, settings=()):
+    """Add users 1..users to both databases, each with one pill record.
+
+    HackBot users start their day on a random hour; if settings are
+    given, every odd user has a random one of them as timer setting.
+    """
+    db = sqlite3.connect("data/hack_data.sqlite")
+    db.executemany("INSERT INTO user(user_id, username, first_name, last_name, language_code, start_time, "
+                   "time_setting) VALUES (?,?,?,?,?,?,?)",
+                   ((i, "user%d" % i, "First", "Last", "en", rng.randrange(24) * 3600,
+                     rng.choice(settings) if settings and i % 2 else None) for i in range(1, users + 1)))
+    db.commit()
+    db.close()
+    db = sqlite3.connect("data/pill_data.sqlite")
+    db.executemany("INSERT INTO user VALUES (?,?,?,?,?)",
+                   ((i, "user%d" % i, "First", "Last", "en") for i in range(1, users + 1)))
+    db.executemany("INSERT INTO pill_record(user_id, chat_id, alarm_time, description) VALUES (?,?,?,?)",
+                   ((i, i, rng.randrange(1440) * 60, "pill") for i in range(1, users + 1)))
+    db.commit()
+    db.close()
+
+
+def message(chat_id, message_id):
+    """A telegram.Message as far as the plugins look at one."""
+    return types.SimpleNamespace(chat=types.SimpleNamespace(id=chat_id), chat_id=chat_id, message_id=message_id,
+                                 is_accessible=True)
+
+
+class FakeBot:
+    """Stands in for telegram.Bot; every call is recorded in calls."""
+
+    def __init__(self):
+        self.calls = []
+        self._message_id = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._message_id += 1
+        self.calls.append(("send_message", chat_id, text))
+        return types.SimpleNamespace(chat_id=chat_id, message_id=self._message_id)
+
+    async def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(("edit_message_text", chat_id, text))
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.calls.append(("delete_message", chat_id, message_id))
+        return True
+
+
+class VirtualClock:
+    """A timefunc that only moves when told to."""
+
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _dispatched(scheduler):
+    return sum(ns.dispatched for ns in scheduler.namespaces.values())
+
+
+async def settle(scheduler, outbox=None):
+    """Dispatch every event due now, including events entered as due by
+    the actions themselves, wait for them and return the delay until the
+    next event (None if the queue is empty).
+
+    The delay returned by run(blocking=False) is computed before the
+    actions it dispatched have run, so it is only final once a pass
+    dispatches nothing.
+    """
+    while True:
+        before = _dispatched(scheduler)
+        delay = await scheduler.run(blocking=False)
+        await scheduler.join()
+        if outbox is not None:
+            while outbox.depth or outbox.stats()["in_flight"]:
+                await asyncio.sleep(0)
+        if _dispatched(scheduler) == before:
+            return delay
+
+
+async def drive(scheduler, clock: VirtualClock, until: float, outbox=None):
+    """Run scheduler on clock, jumping from one due event to the next,
+    until the clock reaches until.  Returns the number of events dispatched."""
+    start = _dispatched(scheduler)
+    while True:
+        delay = await settle(scheduler, outbox)
+        if delay is None or clock.now + delay > until:
+            clock.now = until
+            return _dispatched(scheduler) - start
+        clock.now += delay
@@ -0,0 +1,172 @@
+"""Simulate days of HackBot and PillBot traffic on a virtual clock.
+
+    python benchmarks/load_harness.py --users 100000 --days 3
+
+The real plugin classes run against temporary SQLite files, an Outbox
+and a StubBot that records every call and can inject latency and
+errors.  The scheduler's clock jumps from one due event to the next, so
+M days take as long as the work done in them.  Every day each user
+presses "Portal hacked" with probability --hack-rate at a random time.
+
+Reported:
+
+- calls per Bot method and injected errors,
+- peak burst: the most calls due within one simulated minute,
+- lateness: how long after its batch became due a call was made, in
+  real seconds, i.e. how late it would have been sent in production,
+- memory: peak RSS, and the Python heap with --tracemalloc.
+"""
+import argparse
+import asyncio
+import collections
+import random
+import resource
+import time
+import tracemalloc
+import types
+
+import telegram
+
+import fixtures
+
+import sched_cond  # noqa: E402
+from BotPlugin import DAY_SECONDS, MINUTE_SECONDS  # noqa: E402
+from HackBot import HackBot  # noqa: E402
+from outbox import Outbox  # noqa: E402
+from PillBot import PillBot  # noqa: E402
+
+START = 1700000000
+
+
+class StubBot:
+    """A telegram.Bot that records calls, optionally slowly or failing."""
+
+    def __init__(self, clock: fixtures.VirtualClock, rng: random.Random, latency: float = 0.0,
+                 error_rate: float = 0.0):
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = collections.Counter()
+        self.errors = 0
+        self.per_minute = collections.Counter()
+        self.lateness = []
+        self.batch_started = time.perf_counter()
+        self._message_id = 0
+
+    async def _call(self, method):
+        self.lateness.append(time.perf_counter() - self.batch_started)
+        if self.latency:
+            await asyncio.sleep(self.rng.expovariate(1 / self.latency))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise telegram.error.NetworkError("injected error")
+        self.calls[method] += 1
+        self.per_minute[int(self.clock.now) // MINUTE_SECONDS] += 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call("send_message")
+        self._message_id += 1
+        return types.SimpleNamespace(chat_id=chat_id, message_id=self._message_id)
+
+    async def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        await self._call("edit_message_text")
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call("delete_message")
+        return True
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def simulate(args):
+    rng = random.Random(args.seed)
+    fixtures.make_data_dir()
+    fixtures.populate(args.users, rng)
+
+    clock = fixtures.VirtualClock(START)
+    bot = StubBot(clock, rng, args.latency, args.error_rate)
+    outbox = Outbox(bot, rate=None, chat_interval=0, timefunc=clock)
+    scheduler = sched_cond.scheduler_condition(timefunc=clock)
+    harness = scheduler.namespace("harness")
+
+    start = time.perf_counter()
+    hack = HackBot(bot, scheduler, outbox, live_message=args.live_message)
+    pill = PillBot(bot, scheduler, outbox)
+    startup = time.perf_counter() - start
+    outbox.start()
+    hack.start()
+    pill.start()
+
+    async def press(user_id, **kwargs):
+        # The button is pressed on the latest reminder, which gets edited
+        records = hack.users[user_id].message_records
+        message_id = records[-1][1] if records else 0
+        user = types.SimpleNamespace(id=user_id)
+        await hack.handle_callback(types.SimpleNamespace(from_user=user, data=hack.prefix + str(user_id),
+                                                         message=fixtures.message(user_id, message_id)))
+
+    async def new_day(**kwargs):
+        day = kwargs["event"].time
+        for user_id in range(1, args.users + 1):
+            if rng.random() < args.hack_rate:
+                harness.enterabs(day + rng.randrange(DAY_SECONDS), 3, press, argument=(user_id,))
+
+    harness.enterabs(START, 0, new_day, interval=DAY_SECONDS)
+
+    until = START + args.days * DAY_SECONDS
+    start = time.perf_counter()
+    while True:
+        bot.batch_started = time.perf_counter()
+        delay = await fixtures.settle(scheduler, outbox)
+        if delay is None or clock.now + delay > until:
+            break
+        clock.now += delay
+    elapsed = time.perf_counter() - start
+
+    await hack.stop()
+    await pill.stop()
+    await outbox.stop()
+
+    print("{} users, {} days: startup {:.3f}s, simulated in {:.3f}s".format(args.users, args.days, startup,
+                                                                           elapsed))
+    for method, count in sorted(bot.calls.items()):
+        print("  {:<20} {:>10}".format(method, count))
+    print("  {:<20} {:>10}".format("injected errors", bot.errors))
+    minute, peak = max(bot.per_minute.items(), key=lambda item: item[1], default=(0, 0))
+    print("peak burst: {} calls in the minute starting at {}".format(peak, time.strftime(
+        "%H:%M UTC", time.gmtime(minute * MINUTE_SECONDS))))
+    print("lateness (s): p50 {:.3f}  p99 {:.3f}  max {:.3f}".format(
+        percentile(bot.lateness, 0.5), percentile(bot.lateness, 0.99), max(bot.lateness, default=0.0)))
+    print("scheduler:", scheduler.stats())
+    print("outbox:", outbox.stats())
+    print("peak RSS: {:.1f} MiB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        print("Python heap: {:.1f} MiB now, {:.1f} MiB peak".format(current / 2 ** 20, peak / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--hack-rate", type=float, default=0.8, help="chance that a user hacks on a given day")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean real seconds per Bot call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance that a Bot call fails")
+    parser.add_argument("--live-message", action="store_true", help="edit HackBot reminders in place")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true", help="trace the Python heap (slow)")
+    args = parser.parse_args()
+    if args.tracemalloc:
+        tracemalloc.start()
+    asyncio.run(simulate(args))
+
+
+if __name__ == "__main__":
+    main()
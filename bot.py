@@ -1,17 +1,27 @@
+import asyncio
 import logging
-from typing import List
+import time
+from typing import List, Optional, Set
 
 import telegram
-from telegram.ext import CallbackQueryHandler, CallbackContext, CommandHandler, ApplicationBuilder
+from telegram.ext import CallbackQueryHandler, CallbackContext, CommandHandler, Application, ApplicationBuilder
 from telegram.error import TelegramError
 
+import metrics
+import sched_cond
+import tracing
 from BotPlugin import BotPlugin
+from outbox import INTERACTIVE, Outbox
 from HackBot import HackBot
 from TimerBot import TimerBot
 from PillBot import PillBot
 from config import *
 
 BotPlugins: List[BotPlugin] = []
+scheduler_task: Optional[asyncio.Task] = None
+metrics_server: Optional[asyncio.AbstractServer] = None
+# Replies to commands waiting in the outbox, see toHandler()
+replies: Set[asyncio.Task] = set()
 root = logging.getLogger()
 if DEBUG:
     root.setLevel(logging.DEBUG)
@@ -33,24 +43,108 @@ async def handleCallBackQuery(update: telegram.Update, context: CallbackContext)
 def telegram_error(error: TelegramError):
     logging.warning('Update "{}" caused error "{}"'.format(error.message))
 
+COMMAND_TIME = metrics.histogram("command_seconds", "Time to handle a command", ["plugin", "command"])
+# Commands slower than this are logged
+SLOW_COMMAND = 0.5
+
+
+def reply_done(task: asyncio.Task):
+    replies.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning("Reply failed: %s", task.exception())
+
+
 def toHandler(bp: BotPlugin) -> CommandHandler:
     async def handle_command(update: telegram.Update, context: CallbackContext):
         if update.message is None:
             return
         if update.message.from_user is None:
             return
-        ret = bp.handle_command(update.message.from_user, update.message.chat, context.args or [])
+        parameters = context.args or []
+        # Known sub-commands only, anything users type would make a label each
+        if not parameters:
+            command = ""
+        elif parameters[0] in bp.commands:
+            command = parameters[0]
+        else:
+            command = "other"
+        start = time.perf_counter()
+        ret = await bp.handle_command(update.message.from_user, update.message.chat, parameters)
+        elapsed = time.perf_counter() - start
+        COMMAND_TIME.labels(bp.prefix, command).observe(elapsed)
+        if elapsed > SLOW_COMMAND:
+            logging.warning("/%s %s took %.3fs", bp.prefix, command, elapsed)
         if ret:
-            return await update.message.reply_html(ret)
+            message = update.message
+            # Answer in the topic of the command and, in groups, quote it
+            reply = None
+            if message.chat.type != telegram.constants.ChatType.PRIVATE:
+                reply = telegram.ReplyParameters(message.message_id, allow_sending_without_reply=True)
+            # Not awaited: updates are handled one at a time, and the reply
+            # may wait out a RetryAfter pause of the whole outbox
+            task = asyncio.ensure_future(bp.outbox.send_message(
+                message.chat_id, ret, priority=INTERACTIVE, parse_mode=telegram.constants.ParseMode.HTML,
+                message_thread_id=message.message_thread_id, reply_parameters=reply))
+            replies.add(task)
+            task.add_done_callback(reply_done)
 
     return CommandHandler(bp.prefix, handle_command)
 
+
+def register_gauges():
+    metrics.gauge("scheduler_queue_depth", "Events pending in the scheduler", lambda: len(scheduler))
+    metrics.gauge("scheduler_pending_events", "Events pending per plugin",
+                  lambda: {(name,): ns.pending for name, ns in scheduler.namespaces.items()}, ["plugin"])
+    metrics.gauge("outbox_depth", "Jobs waiting in the outbox", lambda: outbox.depth)
+    metrics.gauge("outbox_in_flight", "Bot API calls in flight", lambda: outbox.stats()["in_flight"])
+    metrics.gauge("db_queue_depth", "Statements waiting to be committed",
+                  lambda: {(bp.prefix,): bp.db.depth for bp in BotPlugins if hasattr(bp, "db")}, ["plugin"])
+
+
+async def start_workers(application: Application):
+    global scheduler_task, metrics_server
+    outbox.start()
+    for bp in BotPlugins:
+        bp.start()
+    scheduler_task = asyncio.create_task(scheduler.run())
+    if METRICS_PORT is not None:
+        metrics_server = await metrics.serve("127.0.0.1", METRICS_PORT)
+
+
+async def stop_workers(application: Application):
+    # post_stop: the bot can still send, Application.shutdown() has not
+    # closed its HTTP client yet
+    if metrics_server is not None:
+        metrics_server.close()
+    if scheduler_task is not None:
+        scheduler_task.cancel()
+    # Let reminders that are already being sent and replies to commands
+    # finish, then send what is left in the queue
+    await scheduler.join()
+    await asyncio.gather(*replies, return_exceptions=True)
+    await outbox.stop()
+
+
+async def close_plugins(application: Application):
+    for bp in BotPlugins:
+        await bp.stop()
+
+
 if __name__ == '__main__':
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
-    
-    hackBot = HackBot(application.bot)
-    timerBot = TimerBot(application.bot)
-    pillBot = PillBot(application.bot)
+    application = (
+        ApplicationBuilder().token(BOT_TOKEN).post_init(start_workers).post_stop(stop_workers)
+        .post_shutdown(close_plugins).build()
+    )
+    # Before the plugins, which start scheduling (and sampling) while loading
+    tracing.configure(rate=TRACE_SAMPLE_RATE, owners=TRACE_USERS)
+    scheduler = sched_cond.scheduler_condition(timefunc=time.time, backend=SCHEDULER_BACKEND)
+    outbox = Outbox(application.bot)
+
+    hackBot = HackBot(application.bot, scheduler, outbox, live_message=HACK_LIVE_MESSAGE)
+    timerBot = TimerBot(application.bot, scheduler, outbox)
+    pillBot = PillBot(application.bot, scheduler, outbox)
+    BotPlugins.extend([hackBot, timerBot, pillBot])
+    register_gauges()
 
     application.add_handler(toHandler(hackBot))
     application.add_handler(toHandler(timerBot))
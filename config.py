@@ -1,2 +1,11 @@
 DEBUG = True
-BOT_TOKEN = ""
\ No newline at end of file
+BOT_TOKEN = ""
+# "heap" or "wheel" (timing wheel, cheaper with many pending events)
+SCHEDULER_BACKEND = "heap"
+# Local port of the Prometheus /metrics endpoint, None to disable it
+METRICS_PORT = 9464
+# Fraction of scheduler events traced, and users whose events always are
+TRACE_SAMPLE_RATE = 0.01
+TRACE_USERS = []
+# Edit the latest HackBot reminder in place instead of sending a new one
+HACK_LIVE_MESSAGE = False
@@ -0,0 +1,87 @@
+"""Next fire times of many daily reminder chains in one pass.
+
+A chain is a day start time (seconds after midnight UTC) and a timer
+setting: the delays before the end of the day at which a reminder is
+due, in decreasing order.  next_fire_times() returns, for every chain,
+the end of the current day and the first reminder of it still to come.
+
+NumPy is optional.  With it, large batches are computed column-wise
+over arrays; without it, or for a handful of chains where building the
+arrays costs more than it saves, a plain loop gives the same result.
+"""
+
+import math
+from typing import List, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - depends on the environment
+    numpy = None
+
+__all__ = ["next_fire_times", "HAVE_NUMPY"]
+
+DAY_SECONDS = 24 * 60 * 60
+HAVE_NUMPY = numpy is not None
+# Below this many chains the loop is faster than setting up arrays
+NUMPY_MIN = 256
+# Delay padding shorter settings in the matrix; never in the future
+_PAD = 1 << 52
+
+
+def _next_fire_times_py(start_times, settings, now):
+    next_days = []
+    fire_times = []
+    indexes = []
+    for start_time, setting in zip(start_times, settings):
+        next_day = math.floor((now - start_time) / DAY_SECONDS) * DAY_SECONDS + start_time + DAY_SECONDS
+        next_days.append(next_day)
+        for i, delay in enumerate(setting):
+            if next_day - delay > now:
+                fire_times.append(next_day - delay)
+                indexes.append(i)
+                break
+        else:
+            fire_times.append(None)
+            indexes.append(-1)
+    return next_days, fire_times, indexes
+
+
+def _next_fire_times_numpy(start_times, settings, now):
+    # Settings are interned and few, so the delay matrix is built from
+    # one row per distinct setting object, found without hashing tuples
+    ids = numpy.fromiter(map(id, settings), dtype=numpy.uint64, count=len(settings))
+    _, first_of, row_of = numpy.unique(ids, return_index=True, return_inverse=True)
+    rows = [settings[i] for i in first_of.tolist()]
+    width = max(1, max(len(setting) for setting in rows))
+    delays = numpy.full((len(rows), width), _PAD, dtype=numpy.int64)
+    for row, setting in enumerate(rows):
+        delays[row, :len(setting)] = setting
+
+    start = numpy.asarray(start_times, dtype=numpy.int64)
+    next_day = numpy.floor((now - start) / DAY_SECONDS).astype(numpy.int64) * DAY_SECONDS + start + DAY_SECONDS
+    fire = next_day[:, None] - delays[row_of.reshape(-1)]
+    # Delays decrease along a row, so fire times increase and the first
+    # one after now is the next reminder
+    ahead = fire > now
+    index = ahead.argmax(axis=1)
+    chains = numpy.arange(len(index))
+    found = ahead[chains, index]
+    fire_times = fire[chains, index].astype(object)
+    fire_times[~found] = None
+    index[~found] = -1
+    return next_day.tolist(), fire_times.tolist(), index.tolist()
+
+
+def next_fire_times(start_times: Sequence[int], settings: Sequence[Tuple[int, ...]], now: float
+                    ) -> Tuple[List[int], List[int], List[int]]:
+    """Compute the next reminder of every chain at time now.
+
+    Returns three lists in the order of the chains: the end of the
+    current day, the time of the first reminder still to come and its
+    index in the setting, or None and -1 when every reminder of the day
+    has passed.
+
+    """
+    if HAVE_NUMPY and len(start_times) >= NUMPY_MIN:
+        return _next_fire_times_numpy(start_times, settings, now)
+    return _next_fire_times_py(start_times, settings, now)
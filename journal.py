@@ -0,0 +1,249 @@
+"""Append-only journal with compacted snapshots for small records.
+
+Every mutation is one line appended to <path>; compact() writes the
+whole live set to <path>.snapshot and empties the journal, so that
+load() only has to read one snapshot and a short tail.  It does so in
+two steps that may run apart: rotate() moves the journal aside to
+<path>.old, and write_snapshot(), which may run on another thread while
+new lines go to a fresh journal, writes the snapshot to a temporary
+file, renames it over the old one and only then removes <path>.old.
+Replaying a line twice is harmless, so a crash at any point leaves a
+snapshot plus journals that replay to the same live set.
+
+A record is a number of int key fields, numeric value fields and one
+trailing string.  The snapshot stores each numeric field as a column
+(an array.array) followed by the strings, so loading it does not parse
+one line per record.
+"""
+
+import array
+import logging
+import os
+import struct
+import time
+from typing import Dict, Iterable, List, Tuple
+
+__all__ = ["Journal"]
+
+Key = Tuple[int, ...]
+Record = Tuple[Key, tuple]
+
+_ADD = "A"
+_REMOVE = "D"
+_MAGIC = b"JNL1"
+_HEADER = struct.Struct("<4sQ")
+_PARSE = {"q": int, "d": float}
+
+
+def _escape(s: str) -> str:
+    if "\\" in s or "\t" in s or "\n" in s:
+        return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+    return s
+
+
+def _unescape(s: str) -> str:
+    if "\\" not in s:
+        return s
+    out = []
+    chars = iter(s)
+    for c in chars:
+        if c == "\\":
+            c = next(chars, "")
+            c = {"t": "\t", "n": "\n"}.get(c, c)
+        out.append(c)
+    return "".join(out)
+
+
+class Journal:
+
+    def __init__(self, path: str, key_size: int, fields: str, compact_min: int = 4096):
+        """Open the journal at path.
+
+        fields gives the array.array type code ("q" or "d") of every
+        numeric field of a record, starting with its key_size key
+        fields; the trailing string is implied.  due() asks for a
+        compaction once the journal holds more than compact_min lines
+        and more than twice as many as the live set.
+
+        """
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.rotated_path = path + ".old"
+        self.key_size = key_size
+        self.fields = fields
+        self.compact_min = compact_min
+        self._parsers = [_PARSE[code] for code in fields]
+        self._file = None
+        self.appended = 0  # lines in the journal since the last snapshot
+
+        self.recovered = 0
+        self.replayed = 0
+        self.recovery_time = 0.0
+
+    def _load_snapshot(self) -> Dict[Key, tuple]:
+        if not os.path.exists(self.snapshot_path):
+            return dict()
+        with open(self.snapshot_path, "rb") as f:
+            magic, count = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError("{} is not a journal snapshot".format(self.snapshot_path))
+            columns = []
+            for code in self.fields:
+                column = array.array(code)
+                column.fromfile(f, count)
+                columns.append(column)
+            strings = f.read().decode("utf-8").split("\n") if count else []
+        if any("\\" in s for s in strings):
+            strings = [_unescape(s) for s in strings]
+        n = self.key_size
+        keys = zip(*columns[:n]) if n > 1 else zip(columns[0])
+        return dict(zip(keys, zip(*columns[n:], strings)))
+
+    def load(self) -> Dict[Key, tuple]:
+        """Rebuild the live set from the snapshot and the journal.
+
+        A torn last line from a crash is cut off the file, so that the
+        next line is not appended onto it, and a line that does not parse
+        is logged and skipped.
+
+        """
+        start = time.perf_counter()
+        live = self._load_snapshot()
+        replayed = skipped = 0
+        # A journal rotated by a compaction that did not finish comes first
+        for path in (self.rotated_path, self.path):
+            r, s = self._replay(path, live)
+            replayed += r
+            skipped += s
+        # Skipped lines count as appended so that the next compaction drops them
+        self.appended = replayed + skipped
+        self.replayed = replayed
+        self.recovered = len(live)
+        self.recovery_time = time.perf_counter() - start
+        logging.info("%s: recovered %d records (%d replayed) in %.3fs", self.path, self.recovered, replayed,
+                     self.recovery_time)
+        return live
+
+    def _replay(self, path: str, live: Dict[Key, tuple]) -> Tuple[int, int]:
+        """Apply the lines of the journal at path to live.
+
+        Returns the number of lines replayed and of lines skipped.
+
+        """
+        if not os.path.exists(path):
+            return 0, 0
+        n = self.key_size
+        parsers = self._parsers
+        # Operation, the numeric fields and the string
+        width = len(parsers) + 2
+        replayed = skipped = 0
+        torn = None
+        # surrogateescape keeps a torn UTF-8 sequence, and the length of
+        # the torn line in bytes, intact
+        with open(path, encoding="utf-8", errors="surrogateescape") as f:
+            for line in f:
+                if line[-1:] != "\n":
+                    torn = line
+                    break
+                try:
+                    if not line.isascii():
+                        line.encode("utf-8")  # reject invalid UTF-8 here, not when compacting
+                    fields = line[:-1].split("\t")
+                    if len(fields) != (width if fields[0] == _ADD else n + 1):
+                        raise ValueError("{} fields".format(len(fields)))
+                    key = tuple(int(x) for x in fields[1:n + 1])
+                    if fields[0] == _ADD:
+                        value = [p(x) for p, x in zip(parsers[n:], fields[n + 1:])]
+                        value.append(_unescape(fields[-1]))
+                        live[key] = tuple(value)
+                    elif fields[0] == _REMOVE:
+                        live.pop(key, None)
+                    else:
+                        raise ValueError("unknown operation")
+                except (ValueError, IndexError, UnicodeError) as e:
+                    logging.warning("%s: skipping bad record %r: %s", path, line, e)
+                    skipped += 1
+                    continue
+                replayed += 1
+        if torn is not None:
+            logging.warning("%s: dropping torn record %r", path, torn)
+            os.truncate(path, os.path.getsize(path) - len(torn.encode("utf-8", "surrogateescape")))
+            skipped += 1
+        return replayed, skipped
+
+    def open(self):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def _append(self, line: str):
+        self.open()
+        self._file.write(line)
+        self._file.flush()
+        self.appended += 1
+
+    def add(self, key: Key, value: tuple):
+        self._append("\t".join((_ADD, *map(repr, key), *map(repr, value[:-1]), _escape(value[-1]))) + "\n")
+
+    def remove(self, key: Key):
+        self._append("\t".join((_REMOVE, *map(repr, key))) + "\n")
+
+    def due(self, live: int) -> bool:
+        return self.appended > self.compact_min and self.appended > 2 * live
+
+    def compact(self, records: Iterable[Record]):
+        """Replace the snapshot by records and truncate the journal."""
+        records = list(records)
+        self.rotate()
+        self.write_snapshot(records)
+
+    def rotate(self):
+        """Start a new journal, keeping the current one until write_snapshot().
+
+        Call it with the live set taken at the same moment; lines
+        appended afterwards go to the new journal.
+
+        """
+        self.close()
+        if os.path.exists(self.path):
+            if os.path.exists(self.rotated_path):
+                # The last write_snapshot() failed: keep what it did not save
+                with open(self.rotated_path, "a", encoding="utf-8") as old, \
+                        open(self.path, encoding="utf-8") as f:
+                    old.write(f.read())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+        self.appended = 0
+
+    def write_snapshot(self, records: List[Record]):
+        """Replace the snapshot by records and drop the rotated journal.
+
+        Touches neither the journal nor the journal object's state, so
+        it may run on another thread while lines are appended.
+
+        """
+        start = time.perf_counter()
+        n = self.key_size
+        columns = [array.array(code) for code in self.fields]
+        strings = []
+        for key, value in records:
+            for column, x in zip(columns, key + value[:-1]):
+                column.append(x)
+            strings.append(_escape(value[-1]))
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(strings)))
+            for column in columns:
+                column.tofile(f)
+            f.write("\n".join(strings).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+        logging.info("%s: compacted %d records in %.3fs", self.path, len(strings), time.perf_counter() - start)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
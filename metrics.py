@@ -0,0 +1,230 @@
+"""In-process metrics in the Prometheus text format.
+
+Counters and histograms are created once at module level by the code
+they instrument and updated in place; a labelled metric hands out one
+child per combination of label values, so the hot path is a dict lookup
+and a few additions.  Gauges are read from a callback when the metrics
+are rendered, so nothing is paid for them in between.
+
+serve() answers GET requests on a local port, /metrics with render()
+and any other path registered in ROUTES.
+"""
+
+import asyncio
+import bisect
+import logging
+import math
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+__all__ = ["Counter", "Histogram", "Gauge", "Registry", "REGISTRY", "ROUTES", "counter", "histogram", "gauge",
+           "serve"]
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = ['{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[LabelValues, object] = dict()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The child metric for one combination of label values."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{} expects labels {}".format(self.name, self.labelnames))
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        lines.extend(self._samples())
+        return "\n".join(lines) + "\n"
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, values), _format_value(child.value))
+                for values, child in self._children.items()]
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labelnames, values, 'le="{}"'.format(_format_value(bound))),
+                    cumulative))
+            labels = _format_labels(self.labelnames, values)
+            lines.append("{}_sum{} {}".format(self.name, labels, _format_value(child.sum)))
+            lines.append("{}_count{} {}".format(self.name, labels, child.count))
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read from function when rendered.
+
+    function returns a number, or a dict of label values -> number for
+    a labelled gauge.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], Union[float, Dict[LabelValues, float]]],
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def _samples(self):
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, values), _format_value(v))
+                for values, v in value.items()]
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = dict()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Add metric; a gauge replaces an earlier one of the same name."""
+        existing = self.metrics.get(metric.name)
+        if existing is not None and not isinstance(metric, Gauge):
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError("metric {} is already registered".format(metric.name))
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        parts = []
+        for metric in self.metrics.values():
+            try:
+                parts.append(metric.render())
+            except Exception:
+                logging.exception("failed to render metric %s", metric.name)
+        return "".join(parts)
+
+
+REGISTRY = Registry()
+# path -> function returning the body of a GET response
+ROUTES: Dict[str, Callable[[str], str]] = {"/metrics": lambda query: REGISTRY.render()}
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge(name: str, documentation: str, function, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, function, labelnames))
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # headers are not used
+        parts = request.decode("latin-1").split()
+        path, _, query = parts[1].partition("?") if len(parts) >= 2 else ("", "", "")
+        route = ROUTES.get(path) if parts and parts[0] == "GET" else None
+        if route is None:
+            status, body = "404 Not Found", "not found\n"
+        else:
+            status, body = "200 OK", route(query)
+        payload = body.encode("utf-8")
+        writer.write("HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     "Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(payload)).encode("latin-1"))
+        writer.write(payload)
+        await writer.drain()
+    except Exception:
+        logging.exception("metrics request failed")
+    finally:
+        writer.close()
+
+
+async def serve(host: str = "127.0.0.1", port: int = 9464) -> asyncio.AbstractServer:
+    """Start answering GET requests for ROUTES on host:port."""
+    return await asyncio.start_server(_handle, host, port)
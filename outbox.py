@@ -0,0 +1,294 @@
+"""A rate limited queue of Telegram API calls shared by every plugin.
+
+Plugins do not call telegram.Bot directly from their timers any more;
+they go through an Outbox, which
+
+- keeps jobs in a priority queue, so replies to commands (INTERACTIVE)
+  overtake bulk reminders (BULK); BULK producers wait when the queue
+  is full, INTERACTIVE ones never do,
+- enforces a global token bucket and a minimum interval between two
+  messages to the same chat, longer for groups than for private chats,
+- honors RetryAfter by pausing every send and retrying the job,
+- exposes its queue depth and how long jobs waited before being sent.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+import telegram
+
+import metrics
+import tracing
+
+__all__ = ["Outbox", "INTERACTIVE", "BULK"]
+
+INTERACTIVE = 0
+BULK = 1
+
+_sequence = itertools.count()
+
+# Span names of traced calls, by Bot method
+SPANS = {"send_message": "sent", "edit_message_text": "edited", "delete_message": "deleted"}
+
+SEND_TIME = metrics.histogram("outbox_send_seconds", "Duration of Bot API calls", ["method"])
+WAIT_TIME = metrics.histogram("outbox_wait_seconds", "Time jobs spent queued before being sent")
+FAILURES = metrics.counter("outbox_failures_total", "Bot API calls that failed", ["method"])
+RETRIES = metrics.counter("outbox_retries_total", "Bot API calls retried after a flood limit")
+
+
+class TokenBucket:
+    """Allows rate acquisitions per second on average, capacity at once."""
+
+    def __init__(self, rate: float, capacity: float, timefunc=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timefunc = timefunc
+        self._last = timefunc()
+
+    def _refill(self):
+        now = self.timefunc()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self):
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+class Job:
+    __slots__ = ("priority", "sequence", "chat_id", "limited", "method", "args", "kwargs", "future", "enqueued",
+                 "not_before", "retries", "trace")
+
+    def __init__(self, priority: int, chat_id: Any, limited: bool, method: Callable[..., Awaitable], args: tuple,
+                 kwargs: Dict[str, Any], enqueued: float):
+        self.priority = priority
+        self.sequence = next(_sequence)
+        self.chat_id = chat_id
+        self.limited = limited
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued = enqueued
+        self.not_before = 0.0
+        self.retries = 0
+        # The trace of the scheduled action making this call, if any
+        self.trace = tracing.current()
+
+    def __lt__(self, o):
+        return (self.not_before, self.priority, self.sequence) < (o.not_before, o.priority, o.sequence)
+
+
+class Outbox:
+
+    def __init__(self, bot: telegram.Bot, rate: Optional[float] = 30, burst: float = 30,
+                 chat_interval: float = 1.0, group_interval: float = 3.0, maxsize: int = 10000,
+                 max_concurrency: int = 16, max_retries: int = 3, timefunc=time.monotonic):
+        """Initialize a new outbox in front of bot.
+
+        rate and burst configure the global token bucket (rate=None
+        disables it), chat_interval is the minimum number of seconds
+        between two messages to one private chat and group_interval to
+        one group or channel (negative chat ids; Telegram allows about 20
+        messages a minute there), maxsize bounds the number of
+        queued BULK jobs and max_concurrency the number of calls in flight.
+
+        """
+        self.bot = bot
+        self.timefunc = timefunc
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, burst, timefunc) if rate is not None else None
+        self._ready: List[Job] = []  # ordered by priority
+        self._delayed: List[Job] = []  # ordered by not_before
+        self._chat_next: Dict[Any, float] = dict()
+        self._paused_until = 0.0
+        self._space = asyncio.Semaphore(maxsize)
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._wakeup = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+        self._worker: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def depth(self):
+        """Number of jobs waiting to be sent."""
+        return len(self._ready) + len(self._delayed)
+
+    def stats(self):
+        done = self.sent + self.failed
+        return {
+            "depth": self.depth,
+            "in_flight": len(self._tasks),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "wait_avg": self.wait_total / done if done else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the worker once every queued job has been sent."""
+        while self.depth:
+            await asyncio.sleep(0.1)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def call(self, chat_id, priority: int, limited: bool, method: Callable[..., Awaitable], /, *args, **kwargs):
+        """Queue method(*args, **kwargs) and return its result once sent.
+
+        limited calls count against the per-chat interval of chat_id.
+        Errors other than RetryAfter are raised to the caller.  The
+        parameters before method are positional-only, so that kwargs
+        may hold a chat_id of its own, as edit_message_text() does.
+
+        Only BULK jobs count against maxsize: a reply to a command must
+        not queue behind the reminders filling the outbox before its
+        priority is even looked at.
+
+        """
+        bounded = priority != INTERACTIVE
+        if bounded:
+            await self._space.acquire()
+        job = Job(priority, chat_id, limited, method, args, kwargs, self.timefunc())
+        heapq.heappush(self._ready, job)
+        self._wakeup.set()
+        try:
+            return await job.future
+        finally:
+            if bounded:
+                self._space.release()
+
+    async def send_message(self, chat_id, text, priority: int = BULK, **kwargs) -> telegram.Message:
+        return await self.call(chat_id, priority, True, self.bot.send_message, chat_id, text, **kwargs)
+
+    async def edit_message_text(self, text, chat_id, message_id, priority: int = INTERACTIVE, **kwargs):
+        return await self.call(chat_id, priority, True, self.bot.edit_message_text, text=text, chat_id=chat_id,
+                               message_id=message_id, **kwargs)
+
+    async def delete_message(self, chat_id, message_id, priority: int = BULK, **kwargs) -> bool:
+        return await self.call(chat_id, priority, False, self.bot.delete_message, chat_id, message_id, **kwargs)
+
+    async def _wait(self, timeout: Optional[float]):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def run(self):
+        ready = self._ready
+        delayed = self._delayed
+        timefunc = self.timefunc
+
+        while True:
+            now = timefunc()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            while delayed and delayed[0].not_before <= now:
+                job = heapq.heappop(delayed)
+                job.not_before = 0.0
+                heapq.heappush(ready, job)
+            if not ready:
+                await self._wait(delayed[0].not_before - now if delayed else None)
+                continue
+
+            job = heapq.heappop(ready)
+            if job.limited:
+                chat_next = self._chat_next.get(job.chat_id, 0.0)
+                if chat_next > now:
+                    job.not_before = chat_next
+                    heapq.heappush(delayed, job)
+                    continue
+            if self._bucket is not None:
+                await self._bucket.acquire()
+            await self._slots.acquire()
+            now = timefunc()
+            if job.limited:
+                # Users have positive ids; groups, channels and "@channel" do not
+                private = isinstance(job.chat_id, int) and job.chat_id > 0
+                interval = self.chat_interval if private else self.group_interval
+                if interval:
+                    self._chat_next[job.chat_id] = now + interval
+                if len(self._chat_next) > 10000:
+                    self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            task = asyncio.create_task(self._send(job, now))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, job: Job, now: float):
+        method = getattr(job.method, "__name__", "call")
+        started = time.perf_counter()
+        try:
+            result = await job.method(*job.args, **job.kwargs)
+        except telegram.error.RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logging.warning("flood limit hit, pausing outbox for %ss", retry_after)
+            if job.trace is not None:
+                job.trace.span("retry_after", detail={"chat": job.chat_id, "retry_after": retry_after}, user=job.chat_id)
+            self._paused_until = max(self._paused_until, self.timefunc() + retry_after)
+            if job.retries < self.max_retries:
+                job.retries += 1
+                self.retried += 1
+                RETRIES.inc()
+                heapq.heappush(self._ready, job)
+                self._wakeup.set()
+                return
+            self._finish(job, now, error=e)
+        except Exception as e:
+            self._finish(job, now, error=e)
+        else:
+            self._finish(job, now, result=result)
+        finally:
+            SEND_TIME.labels(method).observe(time.perf_counter() - started)
+            self._slots.release()
+
+    def _finish(self, job: Job, now: float, result=None, error: Optional[BaseException] = None):
+        wait = now - job.enqueued
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        WAIT_TIME.observe(wait)
+        if job.trace is not None:
+            method = getattr(job.method, "__name__", "call")
+            if error is not None:
+                job.trace.span("failed", detail={"chat": job.chat_id, "method": method, "wait": wait,
+                                                 "error": repr(error)}, user=job.chat_id)
+            else:
+                job.trace.span(SPANS.get(method, method), detail={"chat": job.chat_id, "wait": wait},
+                               user=job.chat_id)
+        if error is not None:
+            self.failed += 1
+            FAILURES.labels(getattr(job.method, "__name__", "call")).inc()
+        else:
+            self.sent += 1
+        if job.future.done():  # the caller has gone away
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
@@ -0,0 +1,150 @@
+"""Write-behind SQLite persistence for the plugins.
+
+The in-memory state of a plugin is the source of truth; the database
+only has to catch up.  Mutations are queued by execute() and applied by
+a single writer task in batched transactions on a dedicated thread, so
+neither a command handler nor a timer callback waits for an fsync.
+Reads go through a separate connection; with WAL enabled they do not
+block on the writer.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, List, Optional, Sequence, Tuple
+
+import metrics
+
+__all__ = ["WriteBehindDB"]
+
+Statement = Tuple[str, Sequence]
+
+COMMIT_TIME = metrics.histogram("db_commit_seconds", "Time to apply and commit one batch", ["db"])
+STATEMENTS = metrics.counter("db_statements_total", "Statements committed", ["db"])
+
+
+class WriteBehindDB:
+
+    def __init__(self, path: str, batch_size: int = 256, max_delay: float = 0.05):
+        """Open the database at path.
+
+        The writer commits once batch_size statements are queued, or
+        max_delay seconds after the first statement of a batch.
+
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.execute("PRAGMA journal_mode=WAL")
+        self._writer: Optional[sqlite3.Connection] = None  # only used on the executor thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._pending: Deque[Statement] = deque()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task: Optional[asyncio.Task] = None
+
+        self.committed = 0
+        self.batches = 0
+        name = os.path.basename(path)
+        self._commit_time = COMMIT_TIME.labels(name)
+        self._statements = STATEMENTS.labels(name)
+
+    @property
+    def depth(self):
+        """Number of statements waiting to be committed."""
+        return len(self._pending)
+
+    def query(self, sql: str, parameters: Sequence = ()) -> sqlite3.Cursor:
+        """Run a read-only statement right away."""
+        return self.reader.execute(sql, parameters)
+
+    def add_column(self, table: str, column: str, declaration: str):
+        """Add a column to table unless it already has it.
+
+        A schema migration: call it before start(), while nothing is
+        queued for the writer.
+
+        """
+        if column not in {row[1] for row in self.reader.execute("PRAGMA table_info({})".format(table))}:
+            logging.info("%s: adding column %s.%s", self.path, table, column)
+            with self.reader:
+                self.reader.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, declaration))
+
+    def execute(self, sql: str, parameters: Sequence = ()):
+        """Queue a mutation; it is committed by the writer task."""
+        self._pending.append((sql, parameters))
+        self._idle.clear()
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def flush(self):
+        """Wait until every statement queued so far is committed."""
+        await self._idle.wait()
+
+    async def close(self):
+        """Flush the queue, stop the writer and close the connections."""
+        if self._task is not None:
+            await self.flush()
+            self._task.cancel()
+            self._task = None
+        else:
+            # The writer never ran (e.g. shutdown during startup)
+            while self._pending:
+                self._apply(self._take())
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_writer)
+        self._executor.shutdown()
+        self.reader.close()
+
+    def _take(self) -> List[Statement]:
+        pending = self._pending
+        return [pending.popleft() for _ in range(min(self.batch_size, len(pending)))]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        pending = self._pending
+        while True:
+            if not pending:
+                self._idle.set()
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            if len(pending) < self.batch_size:
+                # Group commit: give concurrent mutations a chance to join
+                await asyncio.sleep(self.max_delay)
+            await loop.run_in_executor(self._executor, self._apply, self._take())
+
+    def _apply(self, batch: List[Statement]):
+        if self._writer is None:
+            self._writer = sqlite3.connect(self.path, check_same_thread=False)
+        db = self._writer
+        started = time.perf_counter()
+        try:
+            with db:
+                for sql, parameters in batch:
+                    db.execute(sql, parameters)
+        except sqlite3.Error:
+            # Retry one by one so that a bad statement does not drop the batch
+            for sql, parameters in batch:
+                try:
+                    with db:
+                        db.execute(sql, parameters)
+                except sqlite3.Error:
+                    logging.exception("failed to apply %r %r", sql, parameters)
+        self._commit_time.observe(time.perf_counter() - started)
+        self._statements.inc(len(batch))
+        self.committed += len(batch)
+        self.batches += 1
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -1,19 +1,19 @@
 """A generally useful event scheduler class.
 
-Each instance of this class manages its own queue.
-No multi-threading is implied; you are supposed to hack that
-yourself, or use a single instance per application.
-
-Each instance is parametrized with two functions, one that is
-supposed to return the current time, one that is supposed to
-implement a delay.  You can implement real-time scheduling by
-substituting time and sleep from built-in module time, or you can
-implement simulated time by writing your own functions.  This can
-also be used to integrate scheduling with STDWIN events; the delay
-function is allowed to modify the queue.  Time can be expressed as
-integers or floating point numbers, as long as it is consistent.
-
-Events are specified by tuples (time, priority, action, argument, kwargs).
+Each instance of this class manages its own queue and runs natively on
+an asyncio event loop: a single sleeper task (see run()) waits on a loop
+timer until the earliest event is due, and enterabs() wakes it up when
+an earlier event is queued.  No threads are involved, so every method
+must be called from the loop that runs the scheduler.
+
+Each instance is parametrized with a function that is supposed to
+return the current time.  You can implement real-time scheduling by
+substituting time from built-in module time, or you can implement
+simulated time by writing your own function and driving the scheduler
+with run(blocking=False).  Time can be expressed as integers or
+floating point numbers, as long as it is consistent.
+
+Events are specified by (time, priority, action, argument, kwargs).
 As in UNIX, lower priority numbers mean higher priority; in this
 way the queue can be maintained as a priority queue.  Execution of the
 event means calling the action function, passing it the argument
@@ -25,177 +25,775 @@ has another way to reference private data (besides global variables).
 
 import asyncio
 import heapq
-import time
-import traceback
-from collections import namedtuple
+import itertools
+import logging
+import math
+from time import monotonic as _time, perf_counter
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Sequence, Set, Union
 
-import threading
-from time import monotonic as _time
-from typing import Any, Callable, Coroutine, List, NamedTuple
+import metrics
+import tracing
 
-__all__ = ["scheduler_condition"]
+__all__ = ["scheduler_condition", "SchedulerNamespace", "SchedulerFull", "HeapQueue", "TimingWheel"]
 
 
-class Event(NamedTuple):
+class Event:
     """
     Event(time, priority, action, argument, kwargs)
 
-    A named tuple representing a scheduled event.
+    A handle representing a scheduled event.
 
     Attributes:
         time: Numeric type compatible with the return value of the timefunc function passed to the constructor.
         priority: Events scheduled for the same time will be executed in the order of their priority.
+        sequence: Unique, increasing number; orders events with equal time and priority and
+            gives every handle its own identity.
         action: Executing the event means executing action(*argument, **kwargs).
         argument: A sequence holding the positional arguments for the action.
-        kwargs: A dictionary holding the keyword arguments for the action.
+        kwargs: A dictionary holding the keyword arguments for the action, or None for none;
+            most events have none, so they do not carry an empty dictionary each.
+        cancelled: Whether cancel() has been called while the event was pending.
+        pending: Whether the event is still held by a scheduler queue.
+        plugin: Name of the namespace the event was entered through, if any.
+        owner: Opaque key (e.g. a user id) of whoever the event is scheduled for.
+        interval: For a recurring event, the number of seconds between two occurrences.
+        trace: The tracing.Trace of the event if it is sampled, else None.
     """
-    time: float
-    priority: int
-    action: Callable[..., Coroutine]
-    argument: tuple
-    kwargs: Any
-
-    def __eq__(self, o):
-        return (self.time, self.priority) == (o.time, o.priority)
+    __slots__ = (
+        "time", "priority", "sequence", "action", "argument", "kwargs", "cancelled", "pending", "plugin", "owner",
+        "interval", "trace"
+    )
+
+    def __init__(self, time: float, priority: int, action: Callable[..., Coroutine], argument: tuple, kwargs: Any,
+                 plugin: Optional[str] = None, owner: Any = None, interval: Optional[float] = None):
+        self.time = time
+        self.priority = priority
+        self.sequence = next(_sequence)
+        self.action = action
+        self.argument = argument
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.pending = True
+        self.plugin = plugin
+        self.owner = owner
+        self.interval = interval
+        self.trace: Optional[tracing.Trace] = None
 
     def __lt__(self, o):
-        return (self.time, self.priority) < (o.time, o.priority)
-
-    def __le__(self, o):
-        return (self.time, self.priority) <= (o.time, o.priority)
+        return (self.time, self.priority, self.sequence) < (o.time, o.priority, o.sequence)
 
-    def __gt__(self, o):
-        return (self.time, self.priority) > (o.time, o.priority)
+    def __repr__(self):
+        return "Event(time={!r}, priority={!r}, action={}, argument={!r})".format(
+            self.time, self.priority, getattr(self.action, "__qualname__", self.action), self.argument
+        )
 
-    def __ge__(self, o):
-        return (self.time, self.priority) >= (o.time, o.priority)
 
+_sequence = itertools.count()
 _sentinel = object()
 
+LAG = metrics.histogram("scheduler_lag_seconds", "How long after its time an event was dispatched", ["plugin"])
+ACTION_TIME = metrics.histogram("scheduler_action_seconds", "Run time of scheduled actions", ["plugin"])
+ACTION_FAILURES = metrics.counter("scheduler_action_failures_total", "Scheduled actions that raised", ["plugin"])
+
+# Compaction is not worth it for a handful of tombstones
+COMPACT_THRESHOLD = 64
+
+
+class HeapQueue:
+    """Binary heap of events ordered by (time, priority, sequence).
+
+    Cancelled events stay in the heap as tombstones until they reach
+    the head, or until they make up most of the heap and it is
+    compacted.
+    """
+
+    def __init__(self, now: float = 0):
+        self._heap: List[Event] = []
+        self._cancelled = 0  # tombstones still held by _heap
+
+    def push(self, event: Event):
+        heapq.heappush(self._heap, event)
+
+    def extend(self, events: List[Event]):
+        """Push many events; rebuilds the heap when that is cheaper."""
+        heap = self._heap
+        # k pushes cost about k * log(n) against n + k for heapify()
+        if len(events) * max(1, len(heap).bit_length()) > len(heap):
+            heap.extend(events)
+            heapq.heapify(heap)
+        else:
+            for event in events:
+                heapq.heappush(heap, event)
+
+    def cancel(self, event: Event):
+        self._cancelled += 1
+        if self._cancelled > COMPACT_THRESHOLD and self._cancelled * 2 > len(self._heap):
+            self._compact()
+
+    def _compact(self):
+        """Drop every tombstone and rebuild the heap."""
+        live = []
+        for event in self._heap:
+            if event.cancelled:
+                event.pending = False
+            else:
+                live.append(event)
+        heapq.heapify(live)
+        self._heap = live
+        self._cancelled = 0
+
+    def _head(self) -> Optional[Event]:
+        """Return the earliest live event, dropping tombstones on the way."""
+        q = self._heap
+        while q:
+            event = q[0]
+            if not event.cancelled:
+                return event
+            heapq.heappop(q).pending = False
+            self._cancelled -= 1
+        return None
+
+    def peek(self, now: float) -> Optional[Event]:
+        """Return the next event if it is due at now, else None."""
+        event = self._head()
+        if event is not None and event.time <= now:
+            return event
+        return None
+
+    def pop(self) -> Event:
+        """Remove the event last returned by peek()."""
+        return heapq.heappop(self._heap)
+
+    def deadline(self) -> Optional[float]:
+        """Time at which peek() may return an event next."""
+        event = self._head()
+        return None if event is None else event.time
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def events(self) -> List[Event]:
+        return [e for e in self._heap if not e.cancelled]
+
+
+class TimingWheel:
+    """Hierarchical timing wheel of events.
+
+    Time is cut into ticks of tick seconds.  Level 0 has one bucket per
+    tick for the current block of SLOTS ticks, level 1 one bucket per
+    SLOTS ticks for the current block of SLOTS ** 2 ticks, and so on;
+    events beyond the last level wait in an overflow heap.  Inserting
+    and cancelling are O(1).  Whenever a tick starts, the buckets of
+    the levels above are cascaded down and the level 0 bucket is
+    drained in bulk into a small ready heap, which keeps the usual
+    (time, priority, sequence) order of events within the tick.
+    """
+
+    BITS = 6
+    SLOTS = 1 << BITS
+    MASK = SLOTS - 1
+
+    def __init__(self, now: float = 0, tick: float = 60, levels: int = 4):
+        self.tick = tick
+        self.levels = levels
+        self._current = int(now // tick)  # every tick <= _current is drained
+        self._wheels: List[List[Optional[List[Event]]]] = [[None] * self.SLOTS for _ in range(levels)]
+        self._bucketed = 0  # events (live or not) held by _wheels
+        self._overflow: List[Event] = []
+        self._ready: List[Event] = []
+        self._size = 0  # every event held, tombstones included
+        self._cancelled = 0
+
+    def _place(self, event: Event):
+        t = int(event.time // self.tick)
+        c = self._current
+        if t <= c:
+            heapq.heappush(self._ready, event)
+            return
+        bits = self.BITS
+        for level in range(self.levels):
+            shift = bits * (level + 1)
+            if t >> shift == c >> shift:
+                bucket_list = self._wheels[level]
+                slot = (t >> (bits * level)) & self.MASK
+                bucket = bucket_list[slot]
+                if bucket is None:
+                    bucket_list[slot] = [event]
+                else:
+                    bucket.append(event)
+                self._bucketed += 1
+                return
+        heapq.heappush(self._overflow, event)
+
+    def push(self, event: Event):
+        self._size += 1
+        self._place(event)
+
+    def extend(self, events: List[Event]):
+        self._size += len(events)
+        place = self._place
+        for event in events:
+            place(event)
+
+    def cancel(self, event: Event):
+        self._cancelled += 1
+        if self._cancelled > COMPACT_THRESHOLD and self._cancelled * 2 > self._size:
+            self._compact()
+
+    def _drop(self, event: Event) -> bool:
+        """Forget a tombstone; return whether event was one."""
+        if event.cancelled:
+            event.pending = False
+            self._size -= 1
+            self._cancelled -= 1
+            return True
+        return False
+
+    def _compact(self):
+        """Drop every tombstone from every bucket and heap."""
+        drop = self._drop
+        self._bucketed = 0
+        for buckets in self._wheels:
+            for slot, bucket in enumerate(buckets):
+                if bucket is not None:
+                    bucket = [e for e in bucket if not drop(e)]
+                    buckets[slot] = bucket or None
+                    self._bucketed += len(bucket)
+        for name in ("_ready", "_overflow"):
+            live = [e for e in getattr(self, name) if not drop(e)]
+            heapq.heapify(live)
+            setattr(self, name, live)
+
+    def _cascade(self, level: int):
+        """Spread the current bucket of a level over the levels below."""
+        buckets = self._wheels[level]
+        slot = (self._current >> (self.BITS * level)) & self.MASK
+        bucket = buckets[slot]
+        if bucket is None:
+            return
+        buckets[slot] = None
+        self._bucketed -= len(bucket)
+        drop = self._drop
+        place = self._place
+        for event in bucket:
+            if not drop(event):
+                place(event)
+
+    def _advance(self, now: float):
+        target = int(now // self.tick)
+        if target <= self._current:
+            return
+        bits = self.BITS
+        top_shift = bits * self.levels
+        if not self._bucketed:
+            # Nothing to cascade or drain on the way: jump straight to
+            # target and only pull what overflow has for its block.
+            self._current = target
+            overflow = self._overflow
+            while overflow and int(overflow[0].time // self.tick) >> top_shift <= target >> top_shift:
+                event = heapq.heappop(overflow)
+                if not self._drop(event):
+                    self._place(event)
+            return
+        mask = self.MASK
+        wheel0 = self._wheels[0]
+        while self._current < target:
+            c = self._current = self._current + 1
+            if not c & mask:
+                if not (c & ((1 << top_shift) - 1)):
+                    overflow = self._overflow
+                    while overflow and int(overflow[0].time // self.tick) >> top_shift <= c >> top_shift:
+                        event = heapq.heappop(overflow)
+                        if not self._drop(event):
+                            self._place(event)
+                for level in range(self.levels - 1, 0, -1):
+                    if not c & ((1 << (bits * level)) - 1):
+                        self._cascade(level)
+            bucket = wheel0[c & mask]
+            if bucket is not None:
+                wheel0[c & mask] = None
+                self._bucketed -= len(bucket)
+                ready = self._ready
+                for event in bucket:
+                    if not self._drop(event):
+                        heapq.heappush(ready, event)
+            if not self._bucketed:
+                self._advance(now)
+                return
+
+    def _head(self) -> Optional[Event]:
+        ready = self._ready
+        while ready:
+            event = ready[0]
+            if not self._drop(event):
+                return event
+            heapq.heappop(ready)
+        return None
+
+    def peek(self, now: float) -> Optional[Event]:
+        self._advance(now)
+        event = self._head()
+        if event is not None and event.time <= now:
+            return event
+        return None
+
+    def pop(self) -> Event:
+        self._size -= 1
+        return heapq.heappop(self._ready)
+
+    def deadline(self) -> Optional[float]:
+        event = self._head()
+        if event is not None:
+            return event.time
+        # The first non-empty bucket after the current tick.  A bucket
+        # of level > 0 only gives a lower bound: it is cascaded then.
+        c = self._current
+        bits = self.BITS
+        for level, buckets in enumerate(self._wheels):
+            shift = bits * level
+            for slot in range(((c >> shift) & self.MASK) + 1, self.SLOTS):
+                if buckets[slot] is not None:
+                    return ((((c >> shift) & ~self.MASK) | slot) << shift) * self.tick
+        if self._overflow:
+            return self._overflow[0].time
+        return None
+
+    def __len__(self):
+        return self._size - self._cancelled
+
+    def events(self) -> List[Event]:
+        events = [e for e in self._ready if not e.cancelled]
+        events.extend(e for e in self._overflow if not e.cancelled)
+        for buckets in self._wheels:
+            for bucket in buckets:
+                if bucket is not None:
+                    events.extend(e for e in bucket if not e.cancelled)
+        return events
+
+
+class SchedulerFull(Exception):
+    """Raised when a namespace already holds as many events as its limit."""
+
+
+class SchedulerNamespace:
+    """The view of a shared scheduler_condition given to one plugin.
+
+    Events entered through a namespace are tagged with its name, count
+    against its limit and are reflected in its counters.
+    """
+
+    def __init__(self, scheduler: "scheduler_condition", name: str, limit: Optional[int] = None):
+        self.scheduler = scheduler
+        self.name = name
+        self.limit = limit
+        self.pending = 0
+        self.entered = 0
+        self.cancelled = 0
+        self.dispatched = 0
+        self.failed = 0
+
+    @property
+    def timefunc(self):
+        return self.scheduler.timefunc
+
+    def enterabs(self, time, priority, action: Callable[..., Coroutine], argument=(), kwargs=_sentinel, owner=None,
+                 interval=None):
+        """Enter a new event at an absolute time, see scheduler_condition.enterabs()."""
+        if self.limit is not None and self.pending >= self.limit:
+            raise SchedulerFull("{} already has {} pending events".format(self.name, self.pending))
+        return self.scheduler.enterabs(time, priority, action, argument, kwargs, plugin=self.name, owner=owner,
+                                       interval=interval)
+
+    def enterabs_many(self, times, priority, action: Callable[..., Coroutine], arguments, owners=None,
+                      interval=None) -> List[Event]:
+        """Enter many events at once, see scheduler_condition.enterabs_many()."""
+        if self.limit is not None and self.pending + len(times) > self.limit:
+            raise SchedulerFull("{} cannot take {} more events on top of {} pending".format(
+                self.name, len(times), self.pending))
+        return self.scheduler.enterabs_many(times, priority, action, arguments, plugin=self.name, owners=owners,
+                                            interval=interval)
+
+    def enter(self, delay, priority, action: Callable[..., Coroutine], argument=(), kwargs=_sentinel, owner=None,
+              interval=None):
+        """Enter a new event at a relative time, see scheduler_condition.enter()."""
+        time = self.scheduler.timefunc() + delay
+        return self.enterabs(time, priority, action, argument, kwargs, owner=owner, interval=interval)
+
+    def cancel(self, event):
+        self.scheduler.cancel(event)
+
+    def cancel_owner(self, owner) -> int:
+        """Cancel every pending event of owner, see scheduler_condition.cancel_owner()."""
+        return self.scheduler.cancel_owner(owner, self.name)
+
+    def events_for(self, owner) -> List[Event]:
+        return self.scheduler.events_for(owner, self.name)
+
+    def next_for(self, owner) -> Optional[Event]:
+        return self.scheduler.next_for(owner, self.name)
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "entered": self.entered,
+            "cancelled": self.cancelled,
+            "dispatched": self.dispatched,
+            "failed": self.failed,
+        }
+
+
+BACKENDS = {
+    "heap": HeapQueue,
+    "wheel": TimingWheel,
+}
+
 
 class scheduler_condition:
 
-    def __init__(self, timefunc=_time, delayfunc=time.sleep, loop=None):
-        """Initialize a new instance, passing the time and delay
-        functions"""
-        self._queue: List[Event] = []
-        self._lock = threading.Condition()
-        # self._event = threading.Event()
-        # self._running = True
+    def __init__(self, timefunc=_time, max_concurrency=64, backend="heap"):
+        """Initialize a new instance, passing the time function, the
+        number of actions allowed to run at the same time and the name
+        of the queue backend ("heap" or "wheel")"""
+        self._queue = BACKENDS[backend](timefunc())
+        self._sleeping_until = -math.inf
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
         self.timefunc = timefunc
-        self.delayfunc = delayfunc
+        self.max_concurrency = max_concurrency
+        self.namespaces: Dict[str, SchedulerNamespace] = dict()
+        # plugin -> owner -> pending events, so that one owner's events
+        # can be listed or cancelled without scanning the queue.  Most
+        # owners have a single event, which is stored as is; a set is
+        # only allocated for the second one.
+        self._owners: Dict[Optional[str], Dict[Any, Union[Event, Set[Event]]]] = dict()
 
-        self.running_loop = loop or asyncio.get_event_loop()
+    def namespace(self, name: str, limit: Optional[int] = None) -> SchedulerNamespace:
+        """Return the namespace called name, creating it on first use.
 
-    def enterabs(self, time, priority, action: Callable[..., Coroutine], argument=(), kwargs=_sentinel):
+        A namespace lets a plugin share this scheduler while its events
+        stay tagged with its name and counted separately; limit caps
+        the number of events it may have pending at once.
+
+        """
+        ns = self.namespaces.get(name)
+        if ns is None:
+            ns = self.namespaces[name] = SchedulerNamespace(self, name, limit)
+        elif limit is not None:
+            ns.limit = limit
+        return ns
+
+    def enterabs(self, time, priority, action: Callable[..., Coroutine], argument=(), kwargs=_sentinel,
+                 plugin=None, owner=None, interval=None):
         """Enter a new event in the queue at an absolute time.
 
         Returns an ID for the event which can be used to remove it,
         if necessary.
 
+        If interval is given the event recurs every interval seconds:
+        when it fires, the same event is entered again at its next
+        occurrence after the current time, so cancelling the ID stops
+        the whole series.  The action therefore sees the next
+        occurrence in event.time.
+
         """
         if kwargs is _sentinel:
-            kwargs = {}
-        event = Event(time, priority, action, argument, kwargs)
-        with self._lock:
-            heapq.heappush(self._queue, event)
-            self._lock.notify()
+            kwargs = None
+        event = Event(time, priority, action, argument, kwargs, plugin, owner, interval)
+        event.trace = tracing.start(plugin, owner, action, time, self.timefunc)
+        if plugin is not None:
+            ns = self.namespace(plugin)
+            ns.pending += 1
+            ns.entered += 1
+        if owner is not None:
+            self._index(event)
+        self._queue.push(event)
+        if time < self._sleeping_until:
+            # The sleeper is waiting for a later event (or for nothing)
+            self._wakeup.set()
         return event  # The ID
 
-    def enter(self, delay, priority, action: Callable[..., Coroutine], argument=(), kwargs=_sentinel):
+    def enterabs_many(self, times: Sequence[float], priority, action: Callable[..., Coroutine],
+                      arguments: Sequence[tuple], plugin=None, owners: Optional[Sequence[Any]] = None,
+                      interval=None) -> List[Event]:
+        """Enter one event per time, all of the same priority and action.
+
+        arguments (and owners, if given) hold the argument (owner) of
+        each event, in the order of times.  This is equivalent to as
+        many calls to enterabs(), but the queue takes the events in one
+        batch: the heap is rebuilt once instead of growing one push at
+        a time.  Returns the IDs in the order of times.
+
+        """
+        if owners is None:
+            owners = itertools.repeat(None)
+        timefunc = self.timefunc
+        events = []
+        for time, argument, owner in zip(times, arguments, owners):
+            event = Event(time, priority, action, argument, None, plugin, owner, interval)
+            event.trace = tracing.start(plugin, owner, action, time, timefunc)
+            if owner is not None:
+                self._index(event)
+            events.append(event)
+        if not events:
+            return events
+        if plugin is not None:
+            ns = self.namespace(plugin)
+            ns.pending += len(events)
+            ns.entered += len(events)
+        self._queue.extend(events)
+        if min(event.time for event in events) < self._sleeping_until:
+            self._wakeup.set()
+        return events
+
+    def enter(self, delay, priority, action: Callable[..., Coroutine], argument=(), kwargs=_sentinel,
+              plugin=None, owner=None, interval=None):
         """A variant that specifies the time as a relative time.
 
         This is actually the more commonly used interface.
 
         """
         time = self.timefunc() + delay
-        return self.enterabs(time, priority, action, argument, kwargs)
+        return self.enterabs(time, priority, action, argument, kwargs, plugin, owner, interval)
 
     def cancel(self, event):
         """Remove an event from the queue.
 
         This must be presented the ID as returned by enter().
-        If the event is not in the queue, this raises ValueError.
+        If the event is not in the queue, this is a no-op.
+
+        The event is only marked as cancelled here; the backend drops
+        the tombstone when it would have popped it, or all at once
+        when tombstones make up most of the queue.
+
+        """
+        if event.cancelled or not event.pending:
+            return
+        event.cancelled = True
+        if event.trace is not None:
+            event.trace.span("cancelled")
+        if event.plugin is not None:
+            ns = self.namespaces[event.plugin]
+            ns.pending -= 1
+            ns.cancelled += 1
+        if event.owner is not None:
+            self._unindex(event)
+        self._queue.cancel(event)
+
+    def _index(self, event):
+        owners = self._owners.get(event.plugin)
+        if owners is None:
+            owners = self._owners[event.plugin] = dict()
+        events = owners.get(event.owner)
+        if events is None:
+            owners[event.owner] = event
+        elif type(events) is set:
+            events.add(event)
+        else:
+            owners[event.owner] = {events, event}
+
+    def _unindex(self, event):
+        owners = self._owners.get(event.plugin)
+        if owners is None:
+            return
+        events = owners.get(event.owner)
+        if events is event:
+            del owners[event.owner]
+        elif type(events) is set:
+            events.discard(event)
+            if len(events) == 1:
+                owners[event.owner] = events.pop()
+
+    def _owned(self, owner, plugin):
+        events = self._owners.get(plugin, {}).get(owner)
+        if events is None:
+            return ()
+        if type(events) is set:
+            return events
+        return (events,)
+
+    def cancel_owner(self, owner, plugin=None) -> int:
+        """Cancel every pending event entered for owner through plugin.
+
+        Returns the number of events cancelled.
 
         """
-        with self._lock:
-            if event in self._queue:
-                self._queue.remove(event)
-            heapq.heapify(self._queue)
-            # self._lock.notify()
+        events = self._owned(owner, plugin)
+        if not events:
+            return 0
+        del self._owners[plugin][owner]
+        for event in events:
+            self.cancel(event)
+        return len(events)
+
+    def events_for(self, owner, plugin=None) -> List[Event]:
+        """An ordered list of the pending events of owner."""
+        return sorted(self._owned(owner, plugin))
+
+    def next_for(self, owner, plugin=None) -> Optional[Event]:
+        """The earliest pending event of owner, or None."""
+        return min(self._owned(owner, plugin), default=None)
 
     def empty(self):
         """Check whether the queue is empty."""
-        with self._lock:
-            return not self._queue
-
-    def run(self):
-        """Execute events until the queue is empty.
-        If blocking is False executes the scheduled events due to
-        expire soonest (if any) and then return the deadline of the
-        next scheduled call in the scheduler.
+        return not len(self._queue)
+
+    def __len__(self):
+        """Number of pending (not cancelled) events."""
+        return len(self._queue)
+
+    async def _wait(self, timeout: Optional[float]):
+        """Sleep until timeout elapses or enterabs() wakes us up."""
+        wakeup = self._wakeup
+        handle = None
+        if timeout is not None:
+            handle = asyncio.get_running_loop().call_later(timeout, wakeup.set)
+            self._sleeping_until = self.timefunc() + timeout
+        else:
+            self._sleeping_until = math.inf
+        try:
+            await wakeup.wait()
+        finally:
+            self._sleeping_until = -math.inf
+            wakeup.clear()
+            if handle is not None:
+                handle.cancel()
+
+    def _dispatch(self, event: Event, trace: Optional[tracing.Trace]):
+        """Start the action of a due event as a tracked task."""
+        started = perf_counter()
+        kwargs = event.kwargs
+        try:
+            if kwargs is None:
+                coroutine = event.action(*event.argument, event=event)
+            else:
+                kwargs["event"] = event
+                coroutine = event.action(*event.argument, **kwargs)
+            if trace is not None:
+                coroutine = tracing.traced(trace, coroutine)
+            task = asyncio.ensure_future(coroutine)
+        except Exception as exc:
+            # The action could not even be started (wrong arguments, not
+            # a coroutine function): fail the event, not the scheduler
+            self._slots.release()
+            ACTION_TIME.labels(event.plugin or "").observe(perf_counter() - started)
+            self._failed(event, exc, trace)
+            return
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._dispatched(event, t, started, trace))
+
+    def _dispatched(self, event: Event, task: asyncio.Task, started: float, trace: Optional[tracing.Trace]):
+        self._tasks.discard(task)
+        self._slots.release()
+        ACTION_TIME.labels(event.plugin or "").observe(perf_counter() - started)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self._failed(event, exc, trace)
+            return
+        if trace is not None:
+            trace.span("done")
+        if task.result() is not None:
+            logging.debug("scheduled action %s%r returned %r",
+                          getattr(event.action, "__qualname__", event.action), event.argument, task.result())
+
+    def _failed(self, event: Event, exc: BaseException, trace: Optional[tracing.Trace]):
+        if trace is not None:
+            trace.span("failed", detail=repr(exc))
+        if event.plugin is not None:
+            self.namespaces[event.plugin].failed += 1
+        ACTION_FAILURES.labels(event.plugin or "").inc()
+        logging.error(
+            "scheduled action %s%r failed", getattr(event.action, "__qualname__", event.action),
+            event.argument, exc_info=exc
+        )
+
+    async def run(self, blocking=True):
+        """Execute events until cancelled.
+        If blocking is False dispatches the scheduled events due to
+        expire soonest (if any) and then return the delay until the
+        next scheduled call in the scheduler (None if the queue is
+        empty).
 
         When there is a positive delay until the first event, the
-        delay function is called and the event is left in the queue;
-        otherwise, the event is removed from the queue and executed
-        (its action function is called, passing it the argument).  If
-        the delay function returns prematurely, it is simply
-        restarted.
-
-        It is legal for both the delay function and the action
-        function to modify the queue or to raise an exception;
-        exceptions are not caught but the scheduler's state remains
-        well-defined so run() may be called again.
-
-        A questionable hack is added to allow other threads to run:
-        just after an event is executed, a delay of 0 is executed, to
-        avoid monopolizing the CPU when other threads are also
-        runnable.
+        sleeper waits on a loop timer and the event is left in the
+        queue; otherwise, the event is removed from the queue and its
+        action is started as a task, passing it the argument.  Up to
+        max_concurrency actions run at the same time, so events due
+        together are sent in parallel and a slow action only holds
+        its own slot.  If an earlier event is entered meanwhile, the
+        timer is dropped and the delay recomputed.
+
+        It is legal for the action function to modify the queue or to
+        raise an exception; exceptions are logged when the task
+        finishes and the scheduler keeps running.
 
         """
         # localize variable access to minimize overhead
-        # and to improve thread safety
-        lock = self._lock
         q = self._queue
-        delayfunc = self.delayfunc
         timefunc = self.timefunc
-        pop = heapq.heappop
+        slots = self._slots
 
         while True:
-            with lock:
-                while not q:
-                    self._lock.wait()
-                time, priority, action, argument, kwargs = q[0]
-                now = timefunc()
-                # print(time, now)
-                if time > now:
-                    delay = True
-                else:
-                    delay = False
-                    kwargs["event"] = pop(q)
-
-            if delay:
-                with lock:
-                    self._lock.wait(time - now)
-                # delayfunc(time - now)
+            now = timefunc()
+            event = q.peek(now)
+            if event is None:
+                deadline = q.deadline()
+                if deadline is None:
+                    if not blocking:
+                        return None
+                    await self._wait(None)
+                    continue
+                if deadline > now:
+                    if not blocking:
+                        return deadline - now
+                    await self._wait(deadline - now)
+                continue
+            # Wait for a free slot before popping so that the event
+            # stays visible (and cancellable) while actions are busy.
+            await slots.acquire()
+            now = timefunc()
+            if q.peek(now) is not event:
+                slots.release()
+                continue
+            q.pop()
+            LAG.labels(event.plugin or "").observe(max(0.0, now - event.time))
+            trace = event.trace
+            if trace is not None:
+                trace.span("due", at=event.time)
+                trace.span("dispatched", detail={"lag": now - event.time})
+            if event.plugin is not None:
+                self.namespaces[event.plugin].dispatched += 1
+            if event.interval:
+                # Skip occurrences missed while the process was not running
+                event.time += event.interval * (math.floor((now - event.time) / event.interval) + 1)
+                # Every occurrence is sampled and traced on its own
+                event.trace = tracing.start(event.plugin, event.owner, event.action, event.time, timefunc)
+                q.push(event)
             else:
-                try:
-                    asyncio.run_coroutine_threadsafe(action(*argument, **kwargs), self.running_loop).result()
-                except Exception:
-                    traceback.print_exc()
-                delayfunc(0)  # Let other threads run
+                event.pending = False
+                if event.plugin is not None:
+                    self.namespaces[event.plugin].pending -= 1
+                if event.owner is not None:
+                    self._unindex(event)
+            self._dispatch(event, trace)
+
+    async def join(self):
+        """Wait until every dispatched action has finished."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        """Counters of every namespace, keyed by namespace name."""
+        return {name: ns.stats() for name, ns in self.namespaces.items()}
 
     @property
     def queue(self):
         """An ordered list of upcoming events.
 
-        Events are named tuples with fields for:
+        Events are handles with fields for:
             time, priority, action, arguments, kwargs
 
         """
-        # Use heapq to sort the queue rather than using 'sorted(self._queue)'.
-        # With heapq, two events scheduled at the same time will show in
-        # the actual order they would be retrieved.
-        with self._lock:
-            events = self._queue[:]
-        return list(map(heapq.heappop, [events] * len(events)))
+        return sorted(self._queue.events())
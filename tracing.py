@@ -0,0 +1,144 @@
+"""Sampled lifecycle traces of scheduler events.
+
+A sampled event carries a Trace from the moment it is entered.  The
+scheduler adds the "due" and "dispatched" spans and runs the action
+with the trace in a context variable, so every Bot API call the action
+makes through the Outbox adds a "sent", "edited" or "deleted" span, or
+the error it failed with, even when the plugin swallows that error.
+
+Unsampled events cost one random() call.  Finished and running traces
+are kept in a ring buffer of the most recent ones, which can be dumped
+or searched by user id; metrics.serve() exposes it under /traces.
+"""
+
+import contextvars
+import itertools
+import json
+import random
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+from urllib.parse import parse_qs
+
+import metrics
+
+__all__ = ["Trace", "configure", "start", "current", "traced", "find", "dump"]
+
+# Spans recorded per trace at most; a cohort reminder fans out to many users
+MAX_SPANS = 256
+
+_ids = itertools.count(1)
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+
+sample_rate = 0.01
+# Owners whose events are always traced
+always: Set[Any] = set()
+buffer: Deque["Trace"] = deque(maxlen=10000)
+
+
+class Trace:
+    __slots__ = ("trace_id", "plugin", "owner", "action", "clock", "spans", "users", "dropped")
+
+    def __init__(self, plugin: Optional[str], owner: Any, action: str, clock: Callable[[], float] = time.time):
+        self.trace_id = next(_ids)
+        self.plugin = plugin
+        self.owner = owner
+        self.action = action
+        # Spans are timed on the clock of the scheduler the event was entered in
+        self.clock = clock
+        # (name, time, detail)
+        self.spans: List[tuple] = []
+        # Chats the action talked to, for find()
+        self.users: Set[Any] = set()
+        self.dropped = 0
+
+    def span(self, name: str, at: Optional[float] = None, detail: Any = None, user: Any = None):
+        if user is not None:
+            self.users.add(user)
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append((name, self.clock() if at is None else at, detail))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "plugin": self.plugin,
+            "owner": self.owner,
+            "action": self.action,
+            "spans": [{"name": name, "time": at, "detail": detail} for name, at, detail in self.spans],
+            "dropped_spans": self.dropped,
+        }
+
+
+def configure(rate: Optional[float] = None, owners=None, size: Optional[int] = None):
+    """Change the sample rate, the always traced owners or the buffer size."""
+    global sample_rate, buffer
+    if rate is not None:
+        sample_rate = rate
+    if owners is not None:
+        always.clear()
+        always.update(owners)
+    if size is not None:
+        buffer = deque(buffer, maxlen=size)
+
+
+def start(plugin: Optional[str], owner: Any, action, at: float, clock: Callable[[], float] = time.time
+          ) -> Optional[Trace]:
+    """Return a new Trace for an event entered now, or None if it is not sampled.
+
+    at is the time the event is due on clock.
+
+    """
+    if random.random() >= sample_rate and (not always or owner not in always):
+        return None
+    trace = Trace(plugin, owner, getattr(action, "__qualname__", str(action)), clock)
+    if owner is not None:
+        trace.users.add(owner)
+    trace.span("enqueue", detail={"due": at})
+    buffer.append(trace)
+    return trace
+
+
+def current() -> Optional[Trace]:
+    """The trace of the action running in this context, if any."""
+    return _current.get()
+
+
+async def traced(trace: Trace, coroutine):
+    """Run coroutine with trace as the current trace."""
+    _current.set(trace)
+    return await coroutine
+
+
+def find(user: Any = None, limit: int = 100) -> List[Trace]:
+    """The most recent traces, of user's events or messages if given."""
+    result = []
+    for trace in reversed(buffer):
+        if user is None or user in trace.users:
+            result.append(trace)
+            if len(result) >= limit:
+                break
+    return result
+
+
+def dump(user: Any = None, limit: int = 100) -> str:
+    return json.dumps([trace.as_dict() for trace in find(user, limit)], indent=1, default=str)
+
+
+def _route(query: str) -> str:
+    params = parse_qs(query)
+    user = params.get("user", [None])[0]
+    if user is not None:
+        try:
+            user = int(user)
+        except ValueError:
+            pass
+    try:
+        limit = int(params.get("limit", ["100"])[0])
+    except ValueError:
+        limit = 100
+    return dump(user, limit)
+
+
+metrics.ROUTES["/traces"] = _route